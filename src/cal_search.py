@@ -0,0 +1,173 @@
+"""Batch search for SAT calibration scans over a grid of configurations.
+
+The SAT Source Planner calibration form evaluates one source, array
+focus, boresight and elevation at a time. ``search`` evaluates a whole
+grid of them in a process pool and yields the feasible scans of each
+configuration as its worker finishes, so the page can fill in a ranked
+table while the rest are still running.
+
+Workers run ``evaluate``, which repeats the form's rule chain (sun
+avoidance, ``MakeCESourceScan``, sun avoidance again, minimum duration)
+for one configuration, and finds the wafers the source crosses during
+each scan from its track in boresight coordinates. The pool uses the spawn start method, so workers
+do not inherit the streamlit server's threads, and is shared by all
+sessions to bound the number of processes.
+"""
+import os
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from concurrent.futures.process import BrokenProcessPool
+from functools import lru_cache
+from threading import RLock
+
+import numpy as np
+from schedlib import core, instrument as inst, rules as ru, source as src
+from schedlib.policies.satp1 import make_geometry
+from schedlib.thirdparty import SunAvoidance
+
+import focal_plane
+from trajectory import Trajectory, source_xieta, xieta_source_name
+
+MAX_WORKERS = int(os.environ.get("CAL_SEARCH_WORKERS", 4))
+# focal_plane cache key for the geometry, and most trajectory samples per
+# scan block used to find the wafers hit
+PLATFORM = 'satp1'
+HIT_SAMPLES = 2000
+
+_lock = RLock()
+_pool = None
+
+
+@lru_cache(maxsize=1)
+def _geometry():
+    return make_geometry()
+
+
+@lru_cache(maxsize=16)
+def _source_blocks(source, t0, t1):
+    # each worker sees the same source for many configurations
+    return src.source_gen_seq(source.lower(), t0, t1)
+
+
+def wafers_hit(traj, xi, eta):
+    """Wafers of the geometry whose footprint the source track enters.
+
+    Args:
+      traj (Trajectory): boresight trajectory of a scan block.
+      xi, eta (array): source track in boresight coordinates (radians),
+        from source_xieta.
+    """
+    geometry = _geometry()
+    wafers = focal_plane.positions(
+        PLATFORM, geometry, np.mean(traj.roll), ndet=1
+    )
+    return [
+        waf for waf, (xi_c, eta_c, _, _) in wafers.items()
+        if np.any(
+            np.hypot(xi - xi_c, eta - eta_c)
+            < geometry[waf]['radius'] * focal_plane.DEG
+        )
+    ]
+
+
+def evaluate(config):
+    """Feasible scans for one configuration; runs in a worker process.
+
+    Args:
+      config (dict): source, focus, target (wafer string), boresight,
+        elevation (deg), t0, t1 (datetime), sun_avoid_angle (deg),
+        sun_avoid_time (min), min_scan_duration (min).
+
+    Returns:
+      list of dicts, one per scan block, with the configuration and the
+      scan start, stop, duration (min), az, throw, target and the
+      wafers the source actually crosses (comma separated).
+    """
+    sun = SunAvoidance(
+        min_angle=config['sun_avoid_angle'],
+        min_sun_time=config['sun_avoid_time']*60,
+    )
+    min_dur_rule = ru.make_rule(
+        'min-duration', **{'min_duration': config['min_scan_duration']*60},
+    )
+    src_blocks = sun(
+        _source_blocks(config['source'], config['t0'], config['t1'])
+    )
+    array_info = inst.array_info_from_query(_geometry(), config['target'])
+    ces_rule = ru.MakeCESourceScan(
+        array_info=array_info,
+        el_bore=config['elevation'],
+        drift=True,
+        boresight_rot=config['boresight'],
+        allow_partial=True,
+    )
+    scan_blocks = core.seq_flatten(min_dur_rule(sun(ces_rule(src_blocks))))
+    trajs = [
+        Trajectory.from_block(block, max_samples=HIT_SAMPLES)
+        for block in scan_blocks
+    ]
+    tracks = source_xieta(
+        trajs, xieta_source_name(config['source']), weather='vacuum'
+    )
+
+    rows = []
+    for block, traj, (xi, eta) in zip(scan_blocks, trajs, tracks):
+        rows.append({
+            'source': config['source'],
+            'focus': config['focus'],
+            'boresight': config['boresight'],
+            'elevation': config['elevation'],
+            'start': block.t0,
+            'stop': block.t1,
+            'duration (min)': (block.t1 - block.t0).total_seconds() / 60,
+            'az': block.az,
+            'throw': block.throw,
+            'target': config['target'],
+            'wafers': ','.join(wafers_hit(traj, xi, eta)),
+        })
+    return rows
+
+
+def get_pool():
+    """Process pool shared by every search in this server."""
+    global _pool
+    with _lock:
+        if _pool is None:
+            _pool = ProcessPoolExecutor(
+                max_workers=MAX_WORKERS,
+                mp_context=multiprocessing.get_context('spawn'),
+            )
+        return _pool
+
+
+def search(configs):
+    """Evaluate configs in the pool, yielding results as they finish.
+
+    Yields:
+      (config, rows, error): rows from evaluate, or None and the
+      exception raised for that configuration.
+
+    Configurations not yet started are cancelled if the generator is
+    closed early (e.g. the session re-runs), so they do not hold up the
+    shared pool.
+    """
+    global _pool
+    pool = get_pool()
+    futures = {pool.submit(evaluate, c): c for c in configs}
+    try:
+        for future in as_completed(futures):
+            try:
+                result = future.result()
+            except BrokenProcessPool as e:
+                # a worker died; start a fresh pool for the next search
+                with _lock:
+                    if _pool is pool:
+                        _pool = None
+                yield futures[future], None, e
+            except Exception as e:
+                yield futures[future], None, e
+            else:
+                yield futures[future], result, None
+    finally:
+        for future in futures:
+            future.cancel()
@@ -0,0 +1,78 @@
+"""Process-wide pool of sotodlib Contexts shared by every session.
+
+Opening a Context parses its yaml and opens the obsdb and metadata
+databases, which takes seconds on the site filesystem. The pool keeps
+one Context per platform and only rebuilds it when the context file or
+its obsdb changes on disk.
+"""
+import os
+import sqlite3
+from threading import RLock
+
+from sotodlib import core
+
+CONTEXT_FILE = os.environ.get(
+    "CONTEXT_FILE", "/so/metadata/{platform}/contexts/basic.yaml"
+)
+
+_lock = RLock()
+_pool = {}
+
+
+def _obsdb_file(ctx):
+    # same resolution as Context.reload
+    db_file = ctx['obsdb']
+    if not db_file.startswith('/'):
+        db_file = os.path.join(os.path.split(ctx.filename)[0], db_file)
+    return os.path.abspath(db_file)
+
+
+def _mtimes(*files):
+    out = []
+    for f in files:
+        try:
+            out.append(os.path.getmtime(f))
+        except OSError:
+            out.append(None)
+    return tuple(out)
+
+
+def _share_obsdb(ctx):
+    """Give the obsdb a connection that any session thread may use.
+
+    sqlite3 connections refuse to be used from a thread other than the
+    one that opened them, and streamlit runs every session in its own
+    thread. Reopen the obsdb read-only without that check, or copy it to
+    memory if it was loaded from a compressed dump.
+    """
+    db_file = _obsdb_file(ctx)
+    if db_file.endswith('.gz'):
+        conn = sqlite3.connect(':memory:', check_same_thread=False)
+        ctx.obsdb.conn.backup(conn)
+    else:
+        conn = sqlite3.connect(
+            f"file:{db_file}?mode=ro", uri=True, check_same_thread=False
+        )
+    conn.row_factory = sqlite3.Row
+    ctx.obsdb.conn.close()
+    ctx.obsdb.conn = conn
+
+
+def get_context(platform):
+    """Shared Context for platform.
+
+    The Context is rebuilt when the mtime of the context file or of its
+    obsdb changes; otherwise the cached one is returned. The returned
+    Context is shared, so callers must treat it as read-only.
+    """
+    ctx_file = CONTEXT_FILE.format(platform=platform)
+    with _lock:
+        if platform in _pool:
+            mtimes, ctx = _pool[platform]
+            if mtimes == _mtimes(ctx_file, _obsdb_file(ctx)):
+                return ctx
+
+        ctx = core.Context(ctx_file)
+        _share_obsdb(ctx)
+        _pool[platform] = (_mtimes(ctx_file, _obsdb_file(ctx)), ctx)
+        return ctx
@@ -0,0 +1,329 @@
+"""Precomputed Sun, Moon and planet ephemerides for the SO site.
+
+The table holds the az/el of each body at a fixed cadence over several
+years, stored as a memory-mapped ``.npy`` array next to a small json
+header. Lookups interpolate between the bracketing samples on unit
+vectors, so any page can ask "where is body X at times T" with a single
+vectorized call instead of per-sample ``ephem`` computations.
+
+Build (or rebuild) the table with::
+
+    python src/ephemeris.py build --start 2024-01-01 --stop 2030-01-01
+    python src/ephemeris.py check
+
+With the default 5 minute cadence the interpolated positions agree with
+``ephem`` to better than ``TOLERANCE`` degrees for bodies more than
+``TOLERANCE_MIN_EL`` degrees above the horizon. Closer to (and below) the
+horizon atmospheric refraction changes quickly and the error grows to a
+few tenths of a degree.
+
+``sun_az_el`` is the stateless Sun position used by the pages: it reads
+the table when it covers the requested times and otherwise falls back to
+an analytic, fully vectorized solar position.
+"""
+import os
+import json
+import argparse
+import datetime as dt
+from threading import RLock
+
+import numpy as np
+import ephem
+import so3g.proj as proj
+
+EPHEMERIS_DIR = os.environ.get("EPHEMERIS_DIR", 'ephemeris/')
+
+BODIES = [
+    'sun', 'moon', 'mercury', 'venus', 'mars',
+    'jupiter', 'saturn', 'uranus', 'neptune',
+]
+DEFAULT_CADENCE = 300  # seconds
+TOLERANCE = 0.01  # deg, interpolated vs. ephem at DEFAULT_CADENCE
+TOLERANCE_MIN_EL = 1  # deg, elevation above which TOLERANCE holds
+
+_lock = RLock()
+_tables = {}
+
+
+def _site():
+    return proj.coords.SITES['so']
+
+
+def _observer():
+    return _site().ephem_observer()
+
+
+def _body(name):
+    return getattr(ephem, name.capitalize())()
+
+
+def fixed_body(ra, dec):
+    """New ephem.FixedBody at J2000 ra, dec (deg)."""
+    body = ephem.FixedBody()
+    body._ra = np.deg2rad(ra)
+    body._dec = np.deg2rad(dec)
+    body._epoch = ephem.J2000
+    return body
+
+
+def _to_xyz(az, el):
+    return np.array([
+        np.cos(el)*np.sin(az),
+        np.cos(el)*np.cos(az),
+        np.sin(el),
+    ])
+
+
+def unit_vector(az, el):
+    """Unit vectors (x east, y north, z up) of az/el in degrees, as a
+    (3, ...) array."""
+    return _to_xyz(np.deg2rad(az), np.deg2rad(el))
+
+
+def gmst(times):
+    """Greenwich mean sidereal time (deg, not wrapped) at ctimes ``times``."""
+    jd = np.asarray(times, dtype=float)/86400. + 2440587.5
+    T = (jd - 2451545.0)/36525.
+    return 280.46061837 + 360.98564736629*(jd - 2451545.0) + 0.000387933*T**2
+
+
+def _from_xyz(xyz):
+    x, y, z = xyz
+    az = np.mod(np.arctan2(x, y), 2*np.pi)
+    el = np.arctan2(z, np.hypot(x, y))
+    return az, el
+
+
+def ephem_az_el(body, times, site=None):
+    """Az/el (deg) of ``body`` at each ctime in ``times``, straight from ephem.
+
+    This is the slow reference path the table is built from and checked
+    against. body is a name from BODIES or an ephem Body (e.g. from
+    fixed_body), which is then computed in place.
+    """
+    if site is None:
+        site = _observer()
+    b = _body(body) if isinstance(body, str) else body
+    az = np.zeros(len(times))
+    el = np.zeros(len(times))
+    for i, t in enumerate(times):
+        site.date = ephem.Date(dt.datetime.fromtimestamp(t, dt.timezone.utc))
+        b.compute(site)
+        az[i] = b.az
+        el[i] = b.alt
+    return np.rad2deg(az), np.rad2deg(el)
+
+
+def _refract(el, pressure=1010., temp=15.):
+    """Apparent elevation for true elevation ``el`` (radians).
+
+    Uses the same refraction model as ephem (which the observer from
+    so3g uses with its default pressure and temperature), inverted by
+    fixed-point iteration.
+    """
+    a = el
+    for _ in range(4):
+        adeg = np.rad2deg(a)
+        r_low = np.deg2rad(
+            ((2e-5*adeg + 1.96e-2)*adeg + 1.594e-1) * pressure /
+            ((273 + temp)*((8.45e-2*adeg + 5.05e-1)*adeg + 1))
+        )
+        r_high = 7.888888e-5 * pressure / (
+            (273 + temp)*np.tan(np.maximum(a, np.deg2rad(1)))
+        )
+        a = el + np.where(adeg < 15, r_low, r_high)
+    return a
+
+
+def sun_az_el_analytic(times, lat=None, lon=None):
+    """Apparent Sun az/el (deg) at ctimes ``times``, computed in numpy.
+
+    Low precision solar coordinates (Meeus, Astronomical Algorithms
+    ch. 25) plus nutation, parallax and refraction. Agrees with ephem to
+    better than 0.01 deg while the Sun is above the horizon. There is no
+    shared state, so this is safe to call from any thread.
+    """
+    if lat is None or lon is None:
+        lat, lon = _site().lat, _site().lon
+    times = np.asarray(times, dtype=float)
+
+    jd = times/86400. + 2440587.5
+    T = (jd - 2451545.0)/36525.
+    L0 = 280.46646 + 36000.76983*T + 0.0003032*T**2
+    M = np.deg2rad(357.52911 + 35999.05029*T - 0.0001537*T**2)
+    C = (
+        (1.914602 - 0.004817*T - 0.000014*T**2)*np.sin(M)
+        + (0.019993 - 0.000101*T)*np.sin(2*M)
+        + 0.000289*np.sin(3*M)
+    )
+    omega = np.deg2rad(125.04 - 1934.136*T)
+    lam = np.deg2rad(L0 + C - 0.00569 - 0.00478*np.sin(omega))
+    eps = np.deg2rad(23.439291 - 0.0130042*T + 0.00256*np.cos(omega))
+
+    ra = np.arctan2(np.cos(eps)*np.sin(lam), np.cos(lam))
+    dec = np.arcsin(np.sin(eps)*np.sin(lam))
+
+    gast = gmst(times) - 0.00478*np.sin(omega)*np.cos(eps)
+    H = np.deg2rad(gast + lon) - ra
+    phi = np.deg2rad(lat)
+
+    el = np.arcsin(np.sin(phi)*np.sin(dec) + np.cos(phi)*np.cos(dec)*np.cos(H))
+    az = np.arctan2(
+        -np.cos(dec)*np.sin(H),
+        np.sin(dec)*np.cos(phi) - np.cos(dec)*np.cos(H)*np.sin(phi),
+    )
+    el = _refract(el - np.deg2rad(8.794/3600)*np.cos(el))
+    return np.rad2deg(np.mod(az, 2*np.pi)), np.rad2deg(el)
+
+
+def sun_az_el(times):
+    """Sun az/el (deg) at ctimes ``times``.
+
+    Interpolated from the ephemeris table when it covers ``times``,
+    otherwise computed with sun_az_el_analytic. Neither path touches a
+    shared ephem.Observer, so concurrent sessions can call this freely.
+    """
+    times = np.atleast_1d(np.asarray(times, dtype=float))
+    table = load_table()
+    if table is not None and len(times) > 0:
+        if table.covers(np.min(times), np.max(times), body='sun'):
+            return table.az_el('sun', times)
+    return sun_az_el_analytic(times)
+
+
+def build_table(path, t0, t1, cadence=DEFAULT_CADENCE, bodies=BODIES):
+    """Compute and write the ephemeris table for [t0, t1] into ``path``.
+
+    Args:
+      path (str): directory to write ``az_el.npy`` and ``meta.json`` to.
+      t0, t1 (datetime): time range covered by the table.
+      cadence (float): sample spacing in seconds.
+      bodies (list of str): ephem body names.
+    """
+    os.makedirs(path, exist_ok=True)
+    start = t0.timestamp()
+    n = int(np.ceil((t1.timestamp() - start) / cadence)) + 1
+    times = start + cadence*np.arange(n)
+
+    data = np.lib.format.open_memmap(
+        os.path.join(path, 'az_el.npy'), mode='w+',
+        dtype=np.float32, shape=(len(bodies), 2, n),
+    )
+    site = _observer()
+    for b, body in enumerate(bodies):
+        data[b, 0], data[b, 1] = ephem_az_el(body, times, site=site)
+    data.flush()
+
+    meta = {
+        'start': start,
+        'cadence': cadence,
+        'n': n,
+        'bodies': list(bodies),
+        'site': 'so',
+    }
+    with open(os.path.join(path, 'meta.json'), 'w') as f:
+        json.dump(meta, f, indent=2)
+
+
+class EphemerisTable:
+    """Read-only, memory-mapped view of a table written by build_table."""
+
+    def __init__(self, path):
+        with open(os.path.join(path, 'meta.json')) as f:
+            meta = json.load(f)
+        self.path = path
+        self.start = meta['start']
+        self.cadence = meta['cadence']
+        self.n = meta['n']
+        self.bodies = meta['bodies']
+        self.data = np.load(os.path.join(path, 'az_el.npy'), mmap_mode='r')
+
+    @property
+    def stop(self):
+        return self.start + self.cadence*(self.n - 1)
+
+    def covers(self, t0, t1, body=None):
+        """True if [t0, t1] (ctimes) is inside the table (and body is in it)."""
+        if body is not None and body.lower() not in self.bodies:
+            return False
+        return self.start <= t0 and t1 <= self.stop
+
+    def az_el(self, body, times):
+        """Interpolated az/el (deg) of ``body`` at ctimes ``times``.
+
+        Raises ValueError if the body is not in the table or the times fall
+        outside of it.
+        """
+        times = np.asarray(times, dtype=float)
+        if body.lower() not in self.bodies:
+            raise ValueError(f"Body {body} not in ephemeris table")
+        if times.size and not self.covers(times.min(), times.max()):
+            raise ValueError(
+                f"Times outside of ephemeris table range "
+                f"{self.start} - {self.stop}"
+            )
+        b = self.bodies.index(body.lower())
+
+        x = (times - self.start) / self.cadence
+        i0 = np.clip(np.floor(x).astype(int), 0, self.n - 2)
+        frac = x - i0
+
+        az = np.deg2rad(self.data[b, 0][np.stack([i0, i0+1])])
+        el = np.deg2rad(self.data[b, 1][np.stack([i0, i0+1])])
+        xyz = _to_xyz(az, el)
+        xyz = xyz[:, 0]*(1-frac) + xyz[:, 1]*frac
+        az, el = _from_xyz(xyz / np.linalg.norm(xyz, axis=0))
+        return np.rad2deg(az), np.rad2deg(el)
+
+
+def load_table(path=EPHEMERIS_DIR):
+    """Shared EphemerisTable for ``path``, or None if it has not been built."""
+    with _lock:
+        if path not in _tables:
+            if not os.path.exists(os.path.join(path, 'meta.json')):
+                return None
+            _tables[path] = EphemerisTable(path)
+        return _tables[path]
+
+
+def check_accuracy(table, n_samples=2000, min_el=TOLERANCE_MIN_EL, seed=0):
+    """Max angular error (deg) of the table against ephem, per body.
+
+    Only random times with the body above ``min_el`` are counted.
+    """
+    rng = np.random.default_rng(seed)
+    times = np.sort(rng.uniform(table.start, table.stop, n_samples))
+    errors = {}
+    for body in table.bodies:
+        az0, el0 = ephem_az_el(body, times)
+        az1, el1 = table.az_el(body, times)
+        dot = np.sum(
+            _to_xyz(np.deg2rad(az0), np.deg2rad(el0)) *
+            _to_xyz(np.deg2rad(az1), np.deg2rad(el1)),
+            axis=0,
+        )
+        err = np.rad2deg(np.arccos(np.clip(dot, -1, 1)))
+        errors[body] = float(np.max(err[el0 > min_el], initial=0))
+    return errors
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('action', choices=['build', 'check'])
+    parser.add_argument('--path', default=EPHEMERIS_DIR)
+    parser.add_argument('--start', default='2024-01-01')
+    parser.add_argument('--stop', default='2030-01-01')
+    parser.add_argument('--cadence', type=float, default=DEFAULT_CADENCE)
+    args = parser.parse_args()
+
+    if args.action == 'build':
+        build_table(
+            args.path,
+            dt.datetime.fromisoformat(args.start).replace(tzinfo=dt.timezone.utc),
+            dt.datetime.fromisoformat(args.stop).replace(tzinfo=dt.timezone.utc),
+            cadence=args.cadence,
+        )
+    errors = check_accuracy(EphemerisTable(args.path))
+    for body, err in errors.items():
+        status = 'ok' if err < TOLERANCE else 'FAIL'
+        print(f"{body:>8s}: max error {err:.5f} deg [{status}]")
@@ -0,0 +1,221 @@
+"""Closed-form visibility of fixed (RA/Dec) sources from the SO site.
+
+A fixed source reaches the same elevation at every transit, and the
+hour angle at which it crosses a given elevation follows from the site
+latitude and its declination. The planners use this to reject sources
+that never pass their elevation filter, and to limit track generation to
+the passes that do, before any ephemeris is computed.
+
+For large catalogs (hundreds to thousands of sources), catalog_visibility
+evaluates every source on a shared time grid in one broadcast
+computation and returns visibility windows and a summary table.
+
+Positions are geometric (no refraction or precession), which moves
+crossing times by a few minutes (up to about 3) and elevations by up to
+about half a degree; PASS_MARGIN and EL_MARGIN cover that, and callers
+still apply their exact elevation cut on the tracks they generate.
+"""
+import numpy as np
+import pandas as pd
+import so3g.proj as proj
+
+import ephemeris
+
+SIDEREAL_RATE = 360.98564736629 / 86400  # deg of hour angle per second
+# slack for the geometric approximation: crossing times are off by a few
+# minutes at most, elevations by a small fraction of a degree
+PASS_MARGIN = 600  # seconds
+EL_MARGIN = 0.5  # deg
+# largest (sources x times) block evaluated at once by catalog_visibility
+MAX_CHUNK = 2**22
+
+
+def _site():
+    return proj.coords.SITES['so']
+
+
+def local_sidereal_angle(times, lon=None):
+    """Local mean sidereal time (deg) at ctimes ``times``."""
+    if lon is None:
+        lon = _site().lon
+    return np.mod(ephemeris.gmst(times) + lon, 360)
+
+
+def transit_elevation(dec, lat=None):
+    """Elevation (deg) of a source with declination dec (deg) at transit."""
+    if lat is None:
+        lat = _site().lat
+    return 90 - np.abs(lat - np.asarray(dec, dtype=float))
+
+
+def crossing_hour_angle(dec, el, lat=None):
+    """Hour angle (deg) at which a source rises above / sets below el.
+
+    Returns 180 for sources that stay above el all day and 0 for sources
+    that never reach it, so the source is above el while
+    ``|hour angle| < crossing_hour_angle``.
+    """
+    if lat is None:
+        lat = _site().lat
+    phi = np.deg2rad(lat)
+    dec = np.deg2rad(np.asarray(dec, dtype=float))
+    cos_h = (
+        (np.sin(np.deg2rad(el)) - np.sin(phi)*np.sin(dec))
+        / (np.cos(phi)*np.cos(dec))
+    )
+    return np.rad2deg(np.arccos(np.clip(cos_h, -1, 1)))
+
+
+def windows_above(ra, dec, t0, t1, el, lat=None, lon=None):
+    """Intervals within [t0, t1] (ctimes) where a source is above el (deg).
+
+    Returns:
+      list of (start, stop) ctimes, one per pass, in time order.
+    """
+    h = float(crossing_hour_angle(dec, el, lat=lat))
+    if h <= 0:
+        return []
+    if h >= 180:
+        return [(t0, t1)]
+    # hour angle of the source at t0, in [-180, 180)
+    ha0 = np.mod(local_sidereal_angle(t0, lon=lon) - ra + 180, 360) - 180
+    first = t0 - ha0/SIDEREAL_RATE
+    period = 360/SIDEREAL_RATE
+    half = h/SIDEREAL_RATE
+    transits = first + period*np.arange(-1, np.ceil((t1 - first)/period) + 1)
+    windows = []
+    for tt in transits:
+        a, b = max(tt - half, t0), min(tt + half, t1)
+        if b > a:
+            windows.append((a, b))
+    return windows
+
+
+def visible_range(ra, dec, t0, t1, min_el, margin=PASS_MARGIN):
+    """Smallest part of [t0, t1] holding every pass that gets above min_el.
+
+    A pass is the source's time above the horizon; it counts if the
+    source is above ``min_el - EL_MARGIN`` at some point of it inside
+    [t0, t1]. Tracks only need to be generated over the returned range.
+
+    Returns:
+      (start, stop) ctimes widened by margin (within [t0, t1]), or None
+      if no pass reaches min_el.
+    """
+    high = windows_above(ra, dec, t0, t1, min_el - EL_MARGIN)
+    if not high:
+        return None
+    passes = [
+        (a, b) for a, b in windows_above(ra, dec, t0, t1, 0)
+        if any(a < hb and ha < b for ha, hb in high)
+    ]
+    return (
+        max(t0, passes[0][0] - margin),
+        min(t1, passes[-1][1] + margin),
+    )
+
+
+def az_el(ra, dec, times, lat=None, lon=None):
+    """Geometric az/el (deg) of sources at ctimes, as (sources, times) arrays.
+
+    Args:
+      ra, dec (array): source coordinates in degrees.
+      times (array): ctimes shared by all sources.
+    """
+    site = _site()
+    lat = site.lat if lat is None else lat
+    phi = np.deg2rad(lat)
+    ra = np.atleast_1d(np.asarray(ra, dtype=float))[:, None]
+    dec = np.deg2rad(np.atleast_1d(np.asarray(dec, dtype=float)))[:, None]
+    H = np.deg2rad(local_sidereal_angle(times, lon=lon)[None, :] - ra)
+    cos_h = np.cos(H)
+    el = np.arcsin(np.sin(phi)*np.sin(dec) + np.cos(phi)*np.cos(dec)*cos_h)
+    az = np.arctan2(
+        -np.cos(dec)*np.sin(H),
+        np.sin(dec)*np.cos(phi) - np.cos(dec)*cos_h*np.sin(phi),
+    )
+    return np.rad2deg(np.mod(az, 2*np.pi)), np.rad2deg(el)
+
+
+def _runs(mask):
+    """Row, start and stop (exclusive) column of each run of True in mask."""
+    padded = np.zeros((mask.shape[0], mask.shape[1] + 2), dtype=np.int8)
+    padded[:, 1:-1] = mask
+    rows, starts = np.nonzero(np.diff(padded, axis=1) == 1)
+    _, stops = np.nonzero(np.diff(padded, axis=1) == -1)
+    return rows, starts, stops
+
+
+def catalog_visibility(names, ra, dec, t0, t1, min_el, step=60,
+                       sun_angle=None):
+    """Visibility of a catalog of fixed sources over [t0, t1] (ctimes).
+
+    Every source is evaluated on one grid of step seconds, in blocks of
+    at most MAX_CHUNK samples. A source is visible while it is above
+    min_el (deg) and, if sun_angle is given, more than sun_angle (deg)
+    away from the Sun.
+
+    Returns:
+      summary (DataFrame): one row per source with its max elevation,
+        the time of it, the hours visible and the number of windows.
+      windows (DataFrame): one row per visibility window (name, start,
+        stop, hours), ordered by source then time. Window edges are
+        on the grid.
+    """
+    names = list(names)
+    ra = np.asarray(ra, dtype=float)
+    dec = np.asarray(dec, dtype=float)
+    if len(names) == 0:
+        return (
+            pd.DataFrame(columns=[
+                'name', 'ra', 'dec', 'max el', 'max el time',
+                'hours visible', 'windows',
+            ]),
+            pd.DataFrame(columns=['name', 'start', 'stop', 'hours']),
+        )
+    times = t0 + step*np.arange(int(np.floor((t1 - t0)/step)) + 1)
+    if sun_angle is not None:
+        sun = ephemeris.unit_vector(*ephemeris.sun_az_el(times))
+        cos_sun = np.cos(np.deg2rad(sun_angle))
+
+    max_el = np.zeros(len(names))
+    max_time = np.zeros(len(names))
+    visible_hours = np.zeros(len(names))
+    rows, starts, stops = [], [], []
+    chunk = max(1, MAX_CHUNK // len(times))
+    for i0 in range(0, len(names), chunk):
+        i1 = min(i0 + chunk, len(names))
+        az, el = az_el(ra[i0:i1], dec[i0:i1], times)
+        visible = el > min_el
+        if sun_angle is not None:
+            x, y, z = ephemeris.unit_vector(az, el)
+            visible &= x*sun[0] + y*sun[1] + z*sun[2] < cos_sun
+        imax = np.argmax(el, axis=1)
+        max_el[i0:i1] = el[np.arange(i1 - i0), imax]
+        max_time[i0:i1] = times[imax]
+        visible_hours[i0:i1] = visible.sum(axis=1) * step / 3600
+
+        r, a, b = _runs(visible)
+        rows.append(r + i0)
+        starts.append(times[a])
+        stops.append(times[b - 1] + step)
+    rows = np.concatenate(rows)
+    starts = np.minimum(np.concatenate(starts), t1)
+    stops = np.minimum(np.concatenate(stops), t1)
+
+    windows = pd.DataFrame({
+        'name': np.array(names, dtype=object)[rows],
+        'start': pd.to_datetime(starts, unit='s', utc=True),
+        'stop': pd.to_datetime(stops, unit='s', utc=True),
+        'hours': (stops - starts) / 3600,
+    })
+    summary = pd.DataFrame({
+        'name': names,
+        'ra': ra,
+        'dec': dec,
+        'max el': max_el,
+        'max el time': pd.to_datetime(max_time, unit='s', utc=True),
+        'hours visible': visible_hours,
+        'windows': np.bincount(rows, minlength=len(names)),
+    })
+    return summary, windows
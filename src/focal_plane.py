@@ -0,0 +1,68 @@
+"""Cached focal-plane positions for the planner focal-plane plots.
+
+The detector ring and centre of every wafer in a schedlib geometry only
+depend on the platform and the boresight roll, so they are decomposed
+into (xi, eta) once per (platform, roll) and shared by every scan block
+and session. Rolls are quantized to ``ROLL_QUANTUM`` so that equal rolls
+from different float arithmetic share an entry.
+"""
+from collections import OrderedDict
+from threading import RLock
+
+import numpy as np
+from so3g.proj import quat
+
+DEG = np.pi / 180
+ROLL_QUANTUM = 0.01 * DEG  # radians
+MAX_ENTRIES = 64
+
+_lock = RLock()
+_cache = OrderedDict()
+
+
+def _compute(geometry, roll, ndet):
+    phi = np.arange(ndet) * 2*np.pi / ndet
+    q_bore_rot = quat.euler(2, -roll) if roll != 0 else None
+    out = {}
+    for waf in geometry:
+        xi0, eta0 = geometry[waf]['center']
+        R = geometry[waf]['radius']
+        qwafer = quat.rotation_xieta(xi0 * DEG, eta0 * DEG)
+        qdets = quat.rotation_xieta(R * DEG * np.cos(phi),
+                                    R * DEG * np.sin(phi))
+        if q_bore_rot is not None:
+            qwafer = q_bore_rot * qwafer
+            qdets = q_bore_rot * qdets
+
+        xi_c, eta_c, _ = quat.decompose_xieta(qwafer)
+        xid, etad, _ = quat.decompose_xieta(qwafer * qdets)
+        for a in (xid, etad):
+            a.setflags(write=False)
+        out[waf] = (float(xi_c), float(eta_c), xid, etad)
+    return out
+
+
+def positions(platform, geometry, roll, ndet=100):
+    """Wafer centres and detector rings of geometry at boresight roll.
+
+    Args:
+      platform (str): cache key for geometry, e.g. 'satp1' or 'lat'.
+      geometry (dict): from schedlib ``make_geometry``, wafer ->
+        {'center': (xi, eta), 'radius': r} in degrees.
+      roll (float): boresight roll in radians.
+      ndet (int): detectors drawn per wafer ring.
+
+    Returns:
+      dict of wafer -> (xi_c, eta_c, xi_dets, eta_dets) in radians, in
+      geometry order. The arrays are shared and read-only.
+    """
+    q = int(np.round(roll / ROLL_QUANTUM))
+    key = (platform, q, ndet)
+    with _lock:
+        if key in _cache:
+            _cache.move_to_end(key)
+            return _cache[key]
+        _cache[key] = _compute(geometry, q * ROLL_QUANTUM, ndet)
+        while len(_cache) > MAX_ENTRIES:
+            _cache.popitem(last=False)
+        return _cache[key]
@@ -0,0 +1,315 @@
+"""Observation history helpers for the Observation History page.
+
+Kept out of the page so the query and classification code can be shared
+by everything that summarizes obsdb (plots, timelines, statistics).
+"""
+import numpy as np
+from matplotlib.colors import ListedColormap
+
+colors = {
+    'idle': (1,1,1),
+    'oper': (0.75, 0.75, 0),
+    'cmb': (0, 0.5, 0),
+    'jupiter_targeted':  np.array([5, 46, 252])/255., ## jupiter light
+    'jupiter': np.array([3, 24, 130])/255., ## jupiter dark
+    'moon_targeted': np.array([197, 7, 240])/255., ## moon bright
+    'moon': np.array([107, 3, 130])/255., ## moon dark
+    'mars_targeted':  np.array([5, 46, 252])/255., ## jupiter light
+    'mars': np.array([3, 24, 130])/255., ## jupiter dark
+    'uranus_targeted': np.array([197, 7, 240])/255., ## moon bright
+    'uranus': np.array([107, 3, 130])/255., ## moon dark
+    'saturn': np.array([252, 186, 3])/255.,
+    'tauA': np.array([240, 99, 12])/255.,
+    'calibration_other': (0, 0, 0),
+    'calibration_other_targeted':  np.array([111, 111, 111])/255.,
+    'streaming_other': (1, 0, 0),
+
+}
+
+# calibration sources with a separate colour when the wafer was targeted
+TARGETED_SOURCES = ['jupiter', 'moon', 'mars', 'uranus']
+
+# Rasters store one uint8 category code per cell; colours are only
+# applied at render time through category_cmap (use with NoNorm).
+categories = list(colors)
+category_codes = {name: i for i, name in enumerate(categories)}
+category_cmap = ListedColormap([colors[name] for name in categories])
+
+
+# obs table columns the history plots need; the LAT also needs tube_slot
+OBS_COLUMNS = [
+    'obs_id', 'start_time', 'stop_time', 'type', 'subtype', 'wafer_slots_list',
+]
+LAT_OBS_COLUMNS = OBS_COLUMNS + ['tube_slot']
+
+
+def query_obs(conn, start, stop, columns=OBS_COLUMNS):
+    """Observations with start <= timestamp < stop, in one obsdb query.
+
+    conn is an obsdb connection (``ctx.obsdb.conn``) or a local mirror
+    from obsdb_mirror. Only the requested columns are read. Results are partitioned in
+    memory (see wafer_index) rather than re-querying per tube or wafer.
+
+    Returns:
+      list of dicts, ordered by obs_id like ObsDb.query.
+    """
+    c = conn.execute(
+        f"SELECT {', '.join(columns)} FROM obs "
+        "WHERE timestamp >= ? AND timestamp < ? ORDER BY obs_id",
+        (start, stop),
+    )
+    return [dict(zip(columns, row)) for row in c]
+
+
+def fetch_tags(conn, start, stop):
+    """Tags of every observation with start <= timestamp < stop.
+
+    One query against the obsdb tags table, instead of one
+    ``obsdb.get(obs_id, tags=True)`` per observation.
+
+    Returns:
+      dict of obs_id -> set of tags.
+    """
+    c = conn.execute(
+        "SELECT obs_id, tag FROM tags WHERE obs_id IN "
+        "(SELECT obs_id FROM obs WHERE timestamp >= ? AND timestamp < ?)",
+        (start, stop),
+    )
+    tags = {}
+    for obs_id, tag in c:
+        tags.setdefault(obs_id, set()).add(tag)
+    return tags
+
+
+def obs_category(obs, tags, target):
+    """Colour category (a key of ``colors``) of obs on the target wafer.
+
+    Args:
+      obs (dict): obsdb row with 'type' and 'subtype'.
+      tags (set): tags of the observation, from fetch_tags.
+      target (str): wafer slot, or tube_wafer for the LAT.
+    """
+    if obs['type'] == 'oper':
+        return 'oper'
+    if obs['subtype'] == 'cmb':
+        return 'cmb'
+    if obs['subtype'] != 'cal':
+        return 'streaming_other'
+    for source in TARGETED_SOURCES:
+        if source in tags:
+            return f'{source}_targeted' if target in tags else source
+    if 'saturn' in tags:
+        return 'saturn'
+    if 'taua' in tags:
+        return 'tauA'
+    if target in tags:
+        return 'calibration_other_targeted'
+    return 'calibration_other'
+
+
+def wafer_index(obs_list, tube=False):
+    """Inverted index of wafer -> positions in obs_list of obs using it.
+
+    With tube=True the keys are ``{tube_slot}_{wafer}``, as used for the
+    LAT.
+    """
+    index = {}
+    for i, obs in enumerate(obs_list):
+        for wafer in (obs['wafer_slots_list'] or '').split(','):
+            key = wafer.strip()
+            if tube:
+                key = f"{obs['tube_slot']}_{key}"
+            index.setdefault(key, []).append(i)
+    return index
+
+
+# rows of the history rasters; the LAT rows are {tube}_{wafer}
+SAT_WAFERS = ['ws0', 'ws1', 'ws2', 'ws3', 'ws4', 'ws5', 'ws6']
+LAT_TUBES = [
+    'c1', 'i1', 'i2', 'i3', 'i4', 'i5', 'i6', 'o1', 'o2', 'o3', 'o4', 'o5', 'o6',
+]
+LAT_WAFERS = ['ws0', 'ws1', 'ws2']
+
+
+def platform_targets(platform):
+    """Raster row labels (wafer slots, or tube_wafer for the LAT)."""
+    if "lat" in platform:
+        return [f"{t}_{w}" for t in LAT_TUBES for w in LAT_WAFERS]
+    return list(SAT_WAFERS)
+
+
+def obs_intervals(obs_list, rows, tags, target):
+    """Start, stop and category code arrays of obs_list[rows] on target."""
+    starts = np.array([obs_list[i]['start_time'] for i in rows], dtype=float)
+    stops = np.array([obs_list[i]['stop_time'] for i in rows], dtype=float)
+    codes = np.array([
+        category_codes[obs_category(
+            obs_list[i], tags.get(obs_list[i]['obs_id'], set()), target
+        )]
+        for i in rows
+    ], dtype=np.uint8)
+    return starts, stops, codes
+
+
+def paint_raster(status, row, edges, obs_list, rows, tags, target):
+    """Paint the category code of obs_list[rows] into status[row].
+
+    status[row, j] is the bin [edges[j], edges[j+1]). Every bin an
+    observation overlaps at all is painted, so observations shorter than
+    a bin still show up at coarse resolution. Longer observations are
+    painted first so short ones land on top instead of being hidden.
+    The bin range of each observation comes from searchsorted, so the
+    cost is per observation rather than per bin.
+    """
+    if len(rows) == 0:
+        return
+    starts, stops, codes = obs_intervals(obs_list, rows, tags, target)
+    n = len(edges) - 1
+    i0 = np.clip(np.searchsorted(edges, starts, side='right') - 1, 0, n)
+    i1 = np.clip(np.searchsorted(edges, stops, side='left'), 0, n)
+    for j in np.argsort(starts - stops, kind='stable'):
+        status[row, i0[j]:i1[j]] = codes[j]
+
+
+def raster_edges(start, stop, n_bins):
+    """Edges of n_bins equal bins spanning [start, stop)."""
+    return np.linspace(start, stop, max(int(n_bins), 1) + 1)
+
+
+def union_intervals(starts, stops):
+    """Merge [start, stop) intervals into sorted, disjoint intervals.
+
+    Empty and inverted intervals are dropped.
+
+    Returns:
+      starts, stops: float arrays of the merged intervals.
+    """
+    starts = np.asarray(starts, dtype=float)
+    stops = np.asarray(stops, dtype=float)
+    keep = stops > starts
+    starts, stops = starts[keep], stops[keep]
+    if len(starts) == 0:
+        return starts, stops
+    order = np.argsort(starts, kind='stable')
+    starts, stops = starts[order], stops[order]
+    reach = np.maximum.accumulate(stops)
+    # a merged interval begins wherever an interval starts after
+    # everything before it has stopped
+    first = np.flatnonzero(np.r_[True, starts[1:] > reach[:-1]])
+    last = np.r_[first[1:] - 1, len(starts) - 1]
+    return starts[first], reach[last]
+
+
+def coverage(starts, stops, edges):
+    """Fraction of each bin [edges[i], edges[i+1]) covered by the intervals.
+
+    Overlapping intervals are only counted once. The covered time up to
+    every edge is read off the cumulative length of the merged intervals,
+    so the cost does not depend on the number of bins per interval.
+    """
+    edges = np.asarray(edges, dtype=float)
+    starts, stops = union_intervals(starts, stops)
+    if len(starts) == 0:
+        return np.zeros(len(edges) - 1)
+    lengths = stops - starts
+    cum = np.r_[0, np.cumsum(lengths)]
+    k = np.searchsorted(starts, edges, side='right') - 1
+    kk = np.maximum(k, 0)
+    covered = np.where(
+        k < 0, 0, cum[kk] + np.clip(edges - starts[kk], 0, lengths[kk])
+    )
+    return np.diff(covered) / np.diff(edges)
+
+
+def lod_tile(obs_list, index, tags, targets, start, stop, step):
+    """Category raster of [start, stop) aggregated into step second bins.
+
+    One level of detail of the history timeline: each bin holds the
+    category observed for the largest part of the bin and the fraction
+    of the bin that was observed at all.
+
+    Args:
+      obs_list, index, tags: from query_obs, wafer_index and fetch_tags.
+      targets (list): raster rows, see platform_targets.
+      start, stop (float): ctimes; stop - start should be a multiple of
+        step.
+      step (float): bin width in seconds.
+
+    Returns:
+      codes (uint8, targets x bins): dominant category code, idle when
+        nothing was observed.
+      duty (float32, targets x bins): observed fraction of each bin.
+    """
+    n = int(round((stop - start) / step))
+    edges = start + step*np.arange(n + 1)
+    codes = np.full((len(targets), n), category_codes['idle'], dtype=np.uint8)
+    duty = np.zeros((len(targets), n), dtype=np.float32)
+    for r, target in enumerate(targets):
+        rows = index.get(target, [])
+        if len(rows) == 0:
+            continue
+        starts, stops, cats = obs_intervals(obs_list, rows, tags, target)
+        fractions = np.zeros((len(categories), n))
+        for code in np.unique(cats):
+            sel = cats == code
+            fractions[code] = coverage(starts[sel], stops[sel], edges)
+        observed = fractions.max(axis=0) > 0
+        codes[r, observed] = fractions.argmax(axis=0)[observed]
+        duty[r] = coverage(starts, stops, edges)
+    return codes, duty
+
+
+def intersect_intervals(a_starts, a_stops, b_starts, b_stops):
+    """Intersection of the unions of two sets of [start, stop) intervals.
+
+    Every merged interval of a is paired with the merged intervals of b
+    that overlap it (found with searchsorted), so the work is linear in
+    the number of overlapping pairs.
+
+    Returns:
+      starts, stops: float arrays of sorted, disjoint intervals.
+    """
+    a_starts, a_stops = union_intervals(a_starts, a_stops)
+    b_starts, b_stops = union_intervals(b_starts, b_stops)
+    lo = np.searchsorted(b_stops, a_starts, side='right')
+    hi = np.searchsorted(b_starts, a_stops, side='left')
+    counts = np.maximum(hi - lo, 0)
+    ia = np.repeat(np.arange(len(a_starts)), counts)
+    ib = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+    ib += np.repeat(lo, counts)
+    starts = np.maximum(a_starts[ia], b_starts[ib])
+    stops = np.minimum(a_stops[ia], b_stops[ib])
+    keep = stops > starts
+    return starts[keep], stops[keep]
+
+
+def interval_length(starts, stops):
+    """Total time covered by the union of [start, stop) intervals."""
+    starts, stops = union_intervals(starts, stops)
+    return float(np.sum(stops - starts))
+
+
+def duty_seconds(obs_list, index, tags, targets, start, stop):
+    """Seconds spent in each category on each target during [start, stop).
+
+    Exact interval arithmetic on the obsdb start/stop times: each
+    category's observations are merged and intersected with the period.
+    Idle is the part of the period not covered by any observation, so
+    the row sums exceed the period only where observations of different
+    categories overlap.
+
+    Returns:
+      float array (targets x categories), columns ordered as categories.
+    """
+    seconds = np.zeros((len(targets), len(categories)))
+    idle = category_codes['idle']
+    for r, target in enumerate(targets):
+        rows = index.get(target, [])
+        starts, stops, cats = obs_intervals(obs_list, rows, tags, target)
+        s, e = intersect_intervals(starts, stops, [start], [stop])
+        seconds[r, idle] = (stop - start) - interval_length(s, e)
+        for code in np.unique(cats):
+            sel = cats == code
+            s, e = intersect_intervals(starts[sel], stops[sel], [start], [stop])
+            seconds[r, code] = interval_length(s, e)
+    return seconds
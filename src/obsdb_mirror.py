@@ -0,0 +1,174 @@
+"""Incremental local mirror of the obsdb fields the history page needs.
+
+Past observations do not change, so each platform's obs rows and tags
+are copied once into a local, indexed SQLite file and later syncs only
+fetch rows newer than the last synced timestamp. History queries then
+read local disk instead of scanning the obsdb on the site filesystem.
+
+The mirror uses the same ``obs``/``tags`` table names as an ObsDb, so
+the queries in history.py run unchanged against either connection.
+"""
+import os
+import time
+import logging
+import sqlite3
+from threading import RLock
+
+from contexts import get_context
+from history import LAT_OBS_COLUMNS
+
+MIRROR_DIR = os.environ.get("OBSDB_MIRROR_DIR", 'obsdb_mirror/')
+
+# Re-fetch this much before the last synced timestamp on each sync, since
+# book binding can add observations a few hours after the fact.
+SYNC_OVERLAP = 86400  # seconds
+# Minimum wall time between syncs of the same platform.
+SYNC_INTERVAL = 600  # seconds
+
+MIRROR_COLUMNS = ['timestamp'] + LAT_OBS_COLUMNS
+
+_SCHEMA = [
+    "CREATE TABLE IF NOT EXISTS obs ("
+    "obs_id TEXT PRIMARY KEY, timestamp REAL, start_time REAL, "
+    "stop_time REAL, type TEXT, subtype TEXT, wafer_slots_list TEXT, "
+    "tube_slot TEXT)",
+    "CREATE INDEX IF NOT EXISTS idx_obs_timestamp ON obs(timestamp)",
+    "CREATE TABLE IF NOT EXISTS tags ("
+    "obs_id TEXT, tag TEXT, PRIMARY KEY (obs_id, tag))",
+]
+
+logger = logging.getLogger(__name__)
+
+_lock = RLock()
+_platform_locks = {}
+_last_sync = {}
+# platform -> exception raised by its last sync, if it failed
+_sync_errors = {}
+# platform -> ctime before which the mirror is complete, as of its last
+# sync, if that sync succeeded
+_complete_until = {}
+# mirror files whose schema was created by this process
+_schema_ready = set()
+
+
+def mirror_file(platform):
+    return os.path.join(MIRROR_DIR, f"{platform}_obsdb.sqlite")
+
+
+def _open(platform):
+    path = mirror_file(platform)
+    with _lock:
+        if path not in _schema_ready:
+            os.makedirs(MIRROR_DIR, exist_ok=True)
+            conn = sqlite3.connect(path)
+            with conn:
+                for stmt in _SCHEMA:
+                    conn.execute(stmt)
+            _schema_ready.add(path)
+            return conn
+    return sqlite3.connect(path)
+
+
+def sync(platform):
+    """Copy obs rows and tags newer than the last synced timestamp.
+
+    Rows within SYNC_OVERLAP of the last synced timestamp are fetched
+    again and replaced, so late-bound observations are picked up.
+
+    Returns:
+      the latest obs timestamp in the mirror after the sync, or None if
+      it is empty.
+    """
+    src = get_context(platform).obsdb.conn
+    available = {r[1] for r in src.execute("PRAGMA table_info(obs)")}
+    cols = [c for c in MIRROR_COLUMNS if c in available]
+
+    conn = _open(platform)
+    try:
+        last = conn.execute("SELECT max(timestamp) FROM obs").fetchone()[0]
+        since = -1 if last is None else last - SYNC_OVERLAP
+
+        rows = src.execute(
+            f"SELECT {', '.join(cols)} FROM obs WHERE timestamp >= ?",
+            (since,),
+        ).fetchall()
+        tags = src.execute(
+            "SELECT DISTINCT obs_id, tag FROM tags WHERE obs_id IN "
+            "(SELECT obs_id FROM obs WHERE timestamp >= ?)",
+            (since,),
+        ).fetchall()
+
+        with conn:
+            conn.executemany(
+                f"INSERT OR REPLACE INTO obs ({', '.join(cols)}) "
+                f"VALUES ({', '.join('?' for _ in cols)})",
+                [tuple(r) for r in rows],
+            )
+            conn.execute(
+                "DELETE FROM tags WHERE obs_id IN "
+                "(SELECT obs_id FROM obs WHERE timestamp >= ?)",
+                (since,),
+            )
+            conn.executemany(
+                "INSERT OR IGNORE INTO tags (obs_id, tag) VALUES (?, ?)",
+                [tuple(r) for r in tags],
+            )
+        return conn.execute("SELECT max(timestamp) FROM obs").fetchone()[0]
+    finally:
+        conn.close()
+
+
+def sync_error(platform):
+    """Exception raised by the platform's last sync, or None."""
+    return _sync_errors.get(platform)
+
+
+def _sync_if_stale(platform):
+    """Sync the platform's mirror if it was not tried in SYNC_INTERVAL.
+
+    If the sync fails (e.g. the obsdb is unreachable), the failure is
+    logged and kept for sync_error, and the mirror is left as it is; the
+    sync is retried after SYNC_INTERVAL.
+    """
+    with _lock:
+        lock = _platform_locks.setdefault(platform, RLock())
+    with lock:
+        if time.time() - _last_sync.get(platform, 0) > SYNC_INTERVAL:
+            try:
+                last = sync(platform)
+                _sync_errors.pop(platform, None)
+                if last is None:
+                    _complete_until.pop(platform, None)
+                else:
+                    _complete_until[platform] = last - SYNC_OVERLAP
+            except Exception as e:
+                logger.warning("obsdb mirror sync of %s failed: %s", platform, e)
+                _sync_errors[platform] = e
+                _complete_until.pop(platform, None)
+            _last_sync[platform] = time.time()
+
+
+def complete_until(platform):
+    """ctime before which the platform's mirror holds every observation.
+
+    That is SYNC_OVERLAP before the latest synced observation, as later
+    ones may still be bound, and follows the obsdb when it lags. Syncs
+    the mirror first if it is stale. None if the last sync failed (or
+    found no observations), in which case nothing in the mirror should
+    be taken as final.
+    """
+    _sync_if_stale(platform)
+    return _complete_until.get(platform)
+
+
+def connect(platform):
+    """Read connection to the platform's mirror, syncing it if stale.
+
+    Sync failures do not raise (see _sync_if_stale); the mirror is then
+    returned as last synced.
+
+    A new connection is returned on every call, so it can be used from
+    the calling session's thread; close it when done.
+    """
+    _sync_if_stale(platform)
+    return _open(platform)
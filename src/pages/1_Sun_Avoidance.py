@@ -1,15 +1,16 @@
+import io
 import datetime as dt
 import numpy as np
+import pandas as pd
 from zoneinfo import ZoneInfo
-import so3g.proj as proj
-import ephem
 
 import streamlit as st
 from matplotlib import pyplot as plt
 
+import ephemeris
+import timeaxis
+
 
-so3gsite = proj.coords.SITES['so']
-site = so3gsite.ephem_observer()
 CHILE = ZoneInfo("America/Santiago")
 UTC = dt.timezone.utc
 
@@ -28,66 +29,155 @@ def meas_angle(az1, el1, az2, el2):
     return np.rad2deg(np.arccos(dot))
 
 
+def time_grid(start, end, delta):
+    """ctimes from start to end, with n samples ~delta minutes apart."""
+    n = int(
+        (end-start).total_seconds()/dt.timedelta(minutes=delta).total_seconds()
+    )
+    step = (end-start).total_seconds()/n
+    return start.timestamp() + step*np.arange(n)
+
+
+def sun_position(ctimes):
+    """Sun azimuth and elevation (radians) at each ctime.
+
+    Stateless (no shared ephem.Observer), so concurrent sessions do not
+    interfere with each other. The track only depends on the time grid,
+    so it is computed once and shared by every pointing evaluated over
+    that grid.
+    """
+    az_sun, el_sun = ephemeris.sun_az_el(ctimes)
+    return np.deg2rad(az_sun), np.deg2rad(el_sun)
+
+
 def sun_angles(
-    tt: list, 
-    Az: float, 
-    El: float, 
-    site:ephem.Observer=site, 
+    track: tuple,
+    Az,
+    El,
     ):
-    
+    """Angle (deg) between the pointing(s) Az, El (deg) and the Sun track.
+
+    Az and El may be arrays; they are broadcast against the time axis, so
+    passing ``az_grid[:, None]`` returns an (az x time) array.
+    """
+    az_sun, el_sun = track
     az = np.deg2rad(Az)
     el = np.deg2rad(El)
-    
-    data = []
-
-
-    # Calculate sun position every 10 minutes
-    for t in tt:
-        site.date = ephem.Date(t)
-        sun = ephem.Sun(site)
-
-        az_sun = sun.az
-        el_sun = sun.alt
-        
-        angle = meas_angle(az, el, az_sun, el_sun)
-        data.append(angle)
-    
-    return data
 
-def plot_sun_angles(Az, El, start, end, delta, thre=45, site=site):
-    n = int(
-        (end-start).total_seconds()/dt.timedelta(minutes=delta).total_seconds()
+    return meas_angle(az, el, az_sun, el_sun)
+
+def refine_crossings(lo, hi, lo_above, Az, El, thre=45, tol=1.0):
+    """Bisect keep-out crossing brackets [lo, hi] (ctimes) down to tol seconds.
+
+    lo_above says whether the Sun angle is above thre at lo. Az, El and
+    thre may be scalars or arrays matching the brackets; the Sun position
+    is evaluated for all brackets at once on each step.
+    """
+    lo = np.asarray(lo, dtype=float)
+    hi = np.asarray(hi, dtype=float)
+    while len(lo) > 0 and np.max(hi - lo) > tol:
+        mid = (lo + hi) / 2
+        mid_above = sun_angles(sun_position(mid), Az, El) > thre
+        same = mid_above == lo_above
+        lo = np.where(same, mid, lo)
+        hi = np.where(same, hi, mid)
+    return (lo + hi) / 2
+
+def find_crossings(Az, El, ctimes, track, thre=45, tol=1.0):
+    """Times at which the Sun angle of Az, El crosses thre.
+
+    Crossings are bracketed on the sampled track and then refined by
+    bisection on the angular distance to within tol seconds.
+
+    Returns:
+      ctimes (array): crossing times.
+      safe (array of bool): True where the pointing becomes safe.
+    """
+    above = sun_angles(track, Az, El) > thre
+    idx = np.nonzero(above[1:] != above[:-1])[0]
+
+    cross = refine_crossings(
+        ctimes[idx], ctimes[idx+1], above[idx], Az, El,
+        thre=thre, tol=tol,
+    )
+    return cross, ~above[idx]
+
+def safe_windows(pointings, ctimes, track, tz=UTC):
+    """Safe windows over ctimes for every pointing in one vectorized pass.
+
+    Args:
+      pointings (DataFrame): one row per pointing with 'az', 'el' and
+        'keep_out' columns (deg).
+      ctimes (array): time grid of the Sun track.
+      track (tuple): Sun az/el on ctimes, from sun_position.
+      tz (tzinfo): time zone of the reported window edges.
+
+    Returns:
+      DataFrame with one row per (pointing, safe window), with window
+      edges refined to the second, and a 'status' column. Pointings
+      that are never safe get one 'never safe' row with no start or
+      stop, so every pointing is reported.
+    """
+    az = pointings['az'].to_numpy(dtype=float)
+    el = pointings['el'].to_numpy(dtype=float)
+    thre = pointings['keep_out'].to_numpy(dtype=float)
+
+    # pointings x times
+    safe = sun_angles(track, az[:, None], el[:, None]) > thre[:, None]
+    edges = np.diff(
+        np.pad(safe, ((0, 0), (1, 1))).astype(np.int8), axis=1
+    )
+    # nonzero is row-major, so starts and stops pair up per pointing
+    p, i_start = np.nonzero(edges == 1)
+    _, i_stop = np.nonzero(edges == -1)
+
+    start = ctimes[i_start]
+    x = i_start > 0
+    start[x] = refine_crossings(
+        ctimes[i_start[x]-1], ctimes[i_start[x]], False,
+        az[p[x]], el[p[x]], thre=thre[p[x]],
+    )
+    stop = ctimes[np.minimum(i_stop, len(ctimes)-1)]
+    x = i_stop < len(ctimes)
+    stop[x] = refine_crossings(
+        ctimes[i_stop[x]-1], ctimes[i_stop[x]], True,
+        az[p[x]], el[p[x]], thre=thre[p[x]],
     )
-    delta = (end-start)/n
-    tt = np.array([start+i*delta for i in range(n)])
 
-    angle = sun_angles(tt, Az, El, site=site)
+    never = np.flatnonzero(~safe.any(axis=1))
+    order = np.argsort(np.r_[p, never], kind='stable')
+    start = np.r_[start, np.full(len(never), np.nan)][order]
+    stop = np.r_[stop, np.full(len(never), np.nan)][order]
+
+    windows = pointings.iloc[np.r_[p, never][order]].reset_index(drop=True)
+    windows['start'] = pd.to_datetime(
+        np.round(start), unit='s', utc=True).tz_convert(tz)
+    windows['stop'] = pd.to_datetime(
+        np.round(stop), unit='s', utc=True).tz_convert(tz)
+    windows['duration (hr)'] = np.nan_to_num(
+        np.round((stop - start) / 3600, 3))
+    windows['status'] = np.where(np.isnan(start), 'never safe', 'safe')
+    return windows
+
+def plot_sun_angles(Az, El, ctimes, track, thre=45, tz=UTC):
+    angle = sun_angles(track, Az, El)
+    tt = timeaxis.to_datetime64(ctimes, tz=tz)
 
     fig, ax = plt.subplots(figsize=(9, 5))  # Adjust as needed
     ax.plot(tt, angle)
     ax.axhline(y=thre, color='r', linestyle='-')
 
     # cross point of the line and the curve
-    cp = []
+    cross, safe = find_crossings(Az, El, ctimes, track, thre=thre)
+    cp = timeaxis.to_datetime64(np.round(cross), tz=tz, unit='s')
     message = ""
-    for i in range(len(tt)-1):
-        if angle[i] < thre and angle[i+1] > thre:
-            message += "{},{} becomes safe at: {}\n".format(
-                Az, El, 
-                tt[i].astimezone(t0.tzinfo).strftime("%Y-%m-%d  %H:%M")
-            )
-            cp.append(tt[i])
-        elif angle[i] > thre and angle[i+1] < thre:
-            x = i-1
-            if x < 0:
-                x=0
-            message += "{},{} becomes UNSAFE at: {}\n".format(
-                Az, El,
-                tt[x].astimezone(t0.tzinfo).strftime("%Y-%m-%d  %H:%M")
-            )
-            cp.append(tt[x])
+    for c, s in zip(cp, safe):
+        message += "{},{} becomes {} at: {}\n".format(
+            Az, El, "safe" if s else "UNSAFE",
+            str(c).replace("T", "  ")
+        )
     if len(cp) == 0:
-        if angle[i] <= thre:
+        if angle[0] <= thre:
             message += "{},{} is always UNSAFE\n".format(
                 Az, El, 
             )
@@ -101,9 +191,9 @@ def plot_sun_angles(Az, El, start, end, delta, thre=45, site=site):
         ax.axvline(x=cp[i], color='black', linestyle='--')
         
     ax.set_ylabel('Sun angle [deg]')
-    if t0.tzinfo == UTC:
+    if tz == UTC:
         x = 'UTC'
-    elif t0.tzinfo == CHILE:
+    elif tz == CHILE:
         x = 'CLT'
     ax.set_xlabel(f'Time ({x})')
     plt.show()
@@ -112,18 +202,52 @@ def plot_sun_angles(Az, El, start, end, delta, thre=45, site=site):
 
     st.text(f"{thre} deg threshold: \n" + message) 
 
+# Grid of the cached keep-out volume. Angles are stored as uint8 in
+# KEEPOUT_RES steps, saturating at 255*KEEPOUT_RES (well above any
+# keep-out angle we would use), so a week at 2 minute sampling is ~130 MB.
+KEEPOUT_AZ = np.arange(0, 360)
+KEEPOUT_EL = np.arange(20, 91)
+KEEPOUT_RES = 0.5
+# Longer windows get a coarser cube cadence, bounding each cached cube
+# to ~130 MB (and the cache to ~520 MB).
+KEEPOUT_MAX_SAMPLES = 5040
+
+def keepout_sampling(start, end, delta):
+    """Cadence (min) of the keep-out cube for a window.
+
+    delta, coarsened where needed so the cube has at most
+    KEEPOUT_MAX_SAMPLES samples.
+    """
+    minutes = (end-start).total_seconds()/60
+    return max(delta, int(np.ceil(minutes / KEEPOUT_MAX_SAMPLES)))
+
+@st.cache_resource(max_entries=4)
+def keepout_cube(start, end, delta):
+    """Sun angle for every (el, az, time) on the keep-out grid.
+
+    This only depends on the time window, so changing the elevation or
+    keep-out angle re-slices the cached volume without any ephemeris work.
+    """
+    ctimes = time_grid(start, end, delta)
+    track = sun_position(ctimes)
+
+    cube = np.empty(
+        (len(KEEPOUT_EL), len(KEEPOUT_AZ), len(ctimes)), dtype=np.uint8
+    )
+    for e, el in enumerate(KEEPOUT_EL):
+        angles = sun_angles(track, KEEPOUT_AZ[:, None], el)
+        cube[e] = np.minimum(np.round(angles / KEEPOUT_RES), 255)
+    return ctimes, track, cube
+
 def plot_sun_keepout(
-        elevation, start, end, delta, thre=45, site=site,
+        elevation, ctimes, cube, thre=45, tz=UTC,
     ):
+    tt = timeaxis.to_datetime64(ctimes, tz=tz)
     az_grid = np.linspace(-90,450,541)
-    n = int((end-start).total_seconds()/dt.timedelta(minutes=5).total_seconds())
-    delta = (end-start)/n
-    tt = np.array([start+i*delta for i in range(n)])
-    angles = np.zeros( (len(az_grid), len(tt)) )
-    for a in range(len(az_grid)):
-        angles[a,:] = sun_angles( tt, az_grid[a], elevation, 
-                                site=site,)
-    
+    e = np.searchsorted(KEEPOUT_EL, elevation)
+    a = np.mod(az_grid, 360).astype(int)
+    angles = cube[e][a].astype(np.float32) * KEEPOUT_RES
+
     fig, ax = plt.subplots(figsize=(9, 7))  # Adjust as needed
     test= ax.imshow(angles.transpose(), origin='lower',aspect='auto',
             extent = [np.min(az_grid), np.max(az_grid), tt[0], tt[-1]])
@@ -186,10 +310,95 @@ with st.form("my data",clear_on_submit=False):
     run_calculation = st.form_submit_button("Calculate")
 
     if run_calculation:
-        t0 = dt.datetime.combine(start_date, start_time, tzinfo=use_TZ)
-        t1 = dt.datetime.combine(end_date, end_time, tzinfo=use_TZ)
-
-        plot_sun_angles(azimuth, elevation, t0, t1, sampling, thre=keep_out)
-        plot_sun_keepout(elevation, t0, t1, sampling, thre=keep_out, site=site,)
+        st.session_state['sun_avoidance'] = {
+            't0': dt.datetime.combine(start_date, start_time, tzinfo=use_TZ),
+            't1': dt.datetime.combine(end_date, end_time, tzinfo=use_TZ),
+            'sampling': sampling,
+            'azimuth': azimuth,
+            'elevation': elevation,
+            'keep_out': keep_out,
+        }
+
+if 'sun_avoidance' in st.session_state:
+    params = st.session_state['sun_avoidance']
+    t0 = params['t0']
+    t1 = params['t1']
+
+    cube_sampling = keepout_sampling(t0, t1, params['sampling'])
+    cube_ctimes, track, cube = keepout_cube(t0, t1, cube_sampling)
+    if cube_sampling == params['sampling']:
+        ctimes = cube_ctimes
+    else:
+        # the angle plot and batch check keep the requested sampling
+        ctimes = time_grid(t0, t1, params['sampling'])
+        track = sun_position(ctimes)
+
+    plot_sun_angles(
+        params['azimuth'], params['elevation'], ctimes, track,
+        thre=params['keep_out'], tz=t0.tzinfo,
+    )
 
+    left_column,  right_column = st.columns(2)
+    with left_column:
+        keepout_el = st.slider(
+            "Keep-out map elevation (deg)",
+            min_value=int(KEEPOUT_EL[0]), max_value=int(KEEPOUT_EL[-1]),
+            value=int(np.clip(params['elevation'], KEEPOUT_EL[0], KEEPOUT_EL[-1])),
+        )
+    with right_column:
+        keepout_thre = st.slider(
+            "Keep-out map angle (deg)",
+            min_value=0, max_value=90, value=params['keep_out'],
+        )
+    if cube_sampling != params['sampling']:
+        st.caption(
+            f"Keep-out map sampled every {cube_sampling} min to bound its "
+            "memory use on this window."
+        )
+    plot_sun_keepout(
+        keepout_el, cube_ctimes, cube, thre=keepout_thre, tz=t0.tzinfo,
+    )
 
+    st.header("Batch Pointing Check")
+    st.write(
+        "Upload a CSV with `az` and `el` columns (deg), and optionally "
+        "`keep_out` (deg, defaults to the Keep Out Angle above) and `name`. "
+        "All pointings are checked over the window above."
+    )
+    pointing_file = st.file_uploader("Pointing list", type=['csv'])
+    if pointing_file is not None:
+        pointings = pd.read_csv(pointing_file)
+        pointings.columns = [c.strip().lower() for c in pointings.columns]
+        if 'keep_out' not in pointings:
+            pointings['keep_out'] = params['keep_out']
+        if not {'az', 'el'}.issubset(pointings.columns):
+            st.error("Pointing list needs az and el columns")
+        else:
+            for c in ['az', 'el', 'keep_out']:
+                pointings[c] = pd.to_numeric(pointings[c], errors='coerce')
+            bad = pointings[['az', 'el', 'keep_out']].isna().any(axis=1)
+            if bad.any():
+                rows = ', '.join(str(i + 1) for i in np.flatnonzero(bad))
+                st.error(
+                    f"Skipped {bad.sum()} pointing(s) with missing or "
+                    f"non-numeric az, el or keep_out (rows {rows})"
+                )
+            windows = safe_windows(
+                pointings[~bad], ctimes, track, tz=t0.tzinfo
+            )
+            st.dataframe(windows)
+
+            left_column,  right_column = st.columns(2)
+            with left_column:
+                st.download_button(
+                    "Download CSV", windows.to_csv(index=False),
+                    file_name="safe_windows.csv", mime="text/csv",
+                )
+            with right_column:
+                buf = io.BytesIO()
+                windows.to_parquet(buf, index=False)
+                st.download_button(
+                    "Download Parquet", buf.getvalue(),
+                    file_name="safe_windows.parquet",
+                    mime="application/octet-stream",
+                )
@@ -1,78 +1,23 @@
+import io
 import numpy as np
 import datetime as dt
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
 import streamlit as st
 from matplotlib import pyplot as plt
+from matplotlib.figure import Figure
 import matplotlib.colors as mcolors
 from matplotlib.patches import Rectangle
-
-from sotodlib import core
-
-colors = {
-    'idle': (1,1,1),
-    'oper': (0.75, 0.75, 0),
-    'cmb': (0, 0.5, 0),
-    'jupiter_targeted':  np.array([5, 46, 252])/255., ## jupiter light
-    'jupiter': np.array([3, 24, 130])/255., ## jupiter dark
-    'moon_targeted': np.array([197, 7, 240])/255., ## moon bright
-    'moon': np.array([107, 3, 130])/255., ## moon dark
-    'mars_targeted':  np.array([5, 46, 252])/255., ## jupiter light
-    'mars': np.array([3, 24, 130])/255., ## jupiter dark
-    'uranus_targeted': np.array([197, 7, 240])/255., ## moon bright
-    'uranus': np.array([107, 3, 130])/255., ## moon dark
-    'saturn': np.array([252, 186, 3])/255.,
-    'tauA': np.array([240, 99, 12])/255.,
-    'calibration_other': (0, 0, 0),
-    'calibration_other_targeted':  np.array([111, 111, 111])/255.,
-    'streaming_other': (1, 0, 0),
-
-}
-
-def get_color_for_obs(ctx, obs, wafer, tube=None):
-    """
-    only send in tube for the LAT
-    """
-    target = wafer
-    if tube is not None:
-        target = f"{tube}_{wafer}"
-    if obs['type'] == 'oper':
-        my_color = colors['oper']
-    elif obs['subtype'] == 'cmb':
-        my_color = colors['cmb']
-    elif obs['subtype'] == 'cal':
-        tags = ctx.obsdb.get(obs['obs_id'], tags=True)['tags']
-        if 'jupiter' in tags:
-            if target in tags:
-                my_color = colors['jupiter_targeted']
-            else:
-                my_color = colors['jupiter']
-        elif 'moon' in tags:
-            if target in tags:
-                my_color = colors['moon_targeted']
-            else:
-                my_color = colors['moon']
-        elif 'mars' in tags:
-            if target in tags:
-                my_color = colors['mars_targeted']
-            else:
-                my_color = colors['mars']
-        elif 'uranus' in tags:
-            if target in tags:
-                my_color = colors['uranus_targeted']
-            else:
-                my_color = colors['uranus']
-        elif 'saturn' in tags:
-            my_color = colors['saturn']
-        elif 'taua' in tags:
-            my_color = colors['tauA']
-        else:
-            if target in tags:
-                my_color = colors['calibration_other_targeted']
-            else:
-                my_color = colors['calibration_other']
-    else:
-        my_color = colors['streaming_other']
-    return my_color
+import pandas as pd
+import plotly.graph_objects as go
+
+import obsdb_mirror
+import timeaxis
+from history import (
+    colors, categories, category_cmap, query_obs, fetch_tags, wafer_index,
+    paint_raster, raster_edges, platform_targets, lod_tile, duty_seconds,
+    OBS_COLUMNS, LAT_OBS_COLUMNS,
+)
 
 def plot_colortable(colors, *, ncols=4, sort_colors=True):
     """taken straight from a matplotlib example"""
@@ -123,36 +68,44 @@ def plot_colortable(colors, *, ncols=4, sort_colors=True):
 
     return fig
 
-def plot_week_sat(ctx, start_dt, stop_dt=None ):
+def axes_pixels(ax):
+    """Width of ax in output pixels, the number of raster bins worth drawing.
+
+    Finer bins cannot be displayed and coarser ones lose detail, so the
+    raster cost follows the figure size instead of the time span.
+    """
+    return int(np.ceil(ax.get_position().width * ax.figure.bbox.width))
+
+def plot_week_sat(conn, start_dt, stop_dt=None ):
     wafers = ['ws0', 'ws1', 'ws2', 'ws3', 'ws4', 'ws5', 'ws6']
 
     start = start_dt.timestamp()
     if stop_dt is None:
         stop_dt = start_dt+dt.timedelta(days=7)
     stop = stop_dt.timestamp()
-    obs_list = ctx.obsdb.query(
-        f"timestamp >= {start} and "
-        f"timestamp < {stop}"
-    )
+    obs_list = query_obs(conn, start, stop)
+    tags = fetch_tags(conn, start, stop)
+    index = wafer_index(obs_list)
 
-    times = np.linspace(start, stop, int((stop-start)/300)+1)
-    status = np.ones( (len(wafers), len(times), 3 ))
+    # Figure rather than pyplot, so this can run in a worker thread
+    fig = Figure(figsize=(12,2.0))
+    ax = fig.add_subplot()
 
-    for w, wafer in enumerate(wafers):
-        obs_with_wafer = [obs for obs in obs_list if wafer in obs['wafer_slots_list']]
+    edges = raster_edges(start, stop, axes_pixels(ax))
+    status = np.zeros( (len(wafers), len(edges)-1), dtype=np.uint8)
 
-        for obs in obs_with_wafer:
-            my_color = get_color_for_obs(ctx, obs, wafer)
-            tmsk = np.all( [times >= obs['start_time'], times < obs['stop_time']], axis=0)
-            status[w][tmsk] = my_color
+    for w, wafer in enumerate(wafers):
+        paint_raster(
+            status, w, edges, obs_list, index.get(wafer, []), tags, wafer
+        )
 
-    fig = plt.figure(figsize=(12,2.0))
-    plt.imshow(status, origin='lower', aspect='auto', interpolation='nearest',
+    ax.imshow(status, origin='lower', aspect='auto', interpolation='nearest',
+          cmap=category_cmap, norm=mcolors.NoNorm(),
           extent=[dt.datetime.utcfromtimestamp(start), dt.datetime.utcfromtimestamp(stop), -0.5, 6.5])
-    plt.yticks(np.arange(len(wafers)), wafers)
+    ax.set_yticks(np.arange(len(wafers)), wafers)
     return fig
 
-def plot_week_lat(ctx, start_dt, stop_dt=None ):
+def plot_week_lat(conn, start_dt, stop_dt=None ):
 
     optics_tubes = ['c1', 'i1', 'i2', 'i3', 'i4', 'i5', 'i6', 'o1', 'o2', 'o3', 'o4', 'o5', 'o6']
     wafers = ['ws0', 'ws1', 'ws2']
@@ -163,37 +116,225 @@ def plot_week_lat(ctx, start_dt, stop_dt=None ):
         stop_dt = start_dt+dt.timedelta(days=7)
     stop = stop_dt.timestamp()
 
-    times = np.linspace(start, stop, int((stop-start)/300)+1)
-    status = np.ones( (tot_wafers, len(times), 3 ))
+    fig = Figure(figsize=(12,10.0))
+    ax = fig.add_subplot()
+
+    edges = raster_edges(start, stop, axes_pixels(ax))
+    status = np.zeros( (tot_wafers, len(edges)-1), dtype=np.uint8)
     labels = []
+    obs_list = query_obs(conn, start, stop, columns=LAT_OBS_COLUMNS)
+    tags = fetch_tags(conn, start, stop)
+    index = wafer_index(obs_list, tube=True)
 
     for t, tube in enumerate(optics_tubes):
-        obs_list = ctx.obsdb.query(
-            f"timestamp >= {start} and "
-            f"timestamp < {stop} and tube_slot == '{tube}'"
+        for w, wafer in enumerate(wafers):
+            target = f"{tube}_{wafer}"
+            labels.append(target)
+            paint_raster(
+                status, int(3*t+w), edges, obs_list, index.get(target, []),
+                tags, target,
+            )
+
+    ax.imshow(status, origin='lower', aspect='auto', interpolation='nearest',
+          cmap=category_cmap, norm=mcolors.NoNorm(),
+          extent=[dt.datetime.utcfromtimestamp(start), dt.datetime.utcfromtimestamp(stop), -0.5, tot_wafers-0.5])
+    for y in np.arange(len(optics_tubes))*3:
+        ax.hlines(y-0.5, color='k',
+                   xmin=dt.datetime.utcfromtimestamp(start),
+                   xmax=dt.datetime.utcfromtimestamp(stop)
         )
+    ax.set_yticks(np.arange(tot_wafers), labels, )
 
-        for w, wafer in enumerate(wafers):
-            labels.append( f"{tube}_{wafer}")
-            obs_with_wafer = [obs for obs in obs_list if wafer in obs['wafer_slots_list']]
+    return fig
+
+# bound on concurrent obsdb queries and renders per history request
+MAX_WORKERS = 4
 
-            for obs in obs_with_wafer:
-                my_color = get_color_for_obs(ctx, obs, wafer, tube)
+def render_week(platform, start_dt, stop_dt):
+    """Query and render one platform/week chunk to png bytes.
+
+    Runs in a worker thread: it opens its own mirror connection and does
+    not touch streamlit.
+    """
+    conn = obsdb_mirror.connect(platform)
+    try:
+        if "sat" in platform:
+            fig = plot_week_sat(conn, start_dt, stop_dt)
+        elif "lat" in platform:
+            fig = plot_week_lat(conn, start_dt, stop_dt)
+    finally:
+        conn.close()
+    fig.suptitle(f"{platform}")
+    buf = io.BytesIO()
+    fig.savefig(buf, format='png')
+    return buf.getvalue()
+
+# levels of detail of the interactive timeline, finest first
+LOD_STEPS = {'5 min': 300, '1 hour': 3600, '1 day': 86400}
+# most bins drawn per row; the finest level that fits is used
+LOD_MAX_BINS = 2500
+# observations are selected by start time, so look back this far for
+# ones running into a day
+OBS_LOOKBACK = 86400  # seconds
+def day_is_final(day, complete_until):
+    """True if the UTC day starting at ctime day can no longer change.
+
+    complete_until is from ``obsdb_mirror.complete_until``: days that end
+    before it are final, and none are if it is None (the mirror may be
+    stale).
+    """
+    return complete_until is not None and day + 86400 <= complete_until
+
+def load_day(platform, day):
+    """Observations, wafer index and tags that can overlap one UTC day."""
+    conn = obsdb_mirror.connect(platform)
+    try:
+        columns = LAT_OBS_COLUMNS if "lat" in platform else OBS_COLUMNS
+        obs_list = query_obs(
+            conn, day - OBS_LOOKBACK, day + 86400, columns=columns
+        )
+        tags = fetch_tags(conn, day - OBS_LOOKBACK, day + 86400)
+    finally:
+        conn.close()
+    return obs_list, wafer_index(obs_list, tube="lat" in platform), tags
+
+def day_tile(platform, day, step):
+    """lod_tile of one UTC day (ctime of midnight) for platform."""
+    obs_list, index, tags = load_day(platform, day)
+    return lod_tile(
+        obs_list, index, tags, platform_targets(platform),
+        day, day + 86400, step,
+    )
 
-                tmsk = np.all( [times >= obs['start_time'], times < obs['stop_time']], axis=0)
-                status[int(3*t+w)][tmsk] = my_color
+@st.cache_data(max_entries=2000, show_spinner=False)
+def completed_day_tile(platform, day, step):
+    """day_tile for a final day (day_is_final); those do not change, so
+    cache them."""
+    return day_tile(platform, day, step)
 
+def day_stats(platform, day, stop=None):
+    """duty_seconds of every target of platform over one UTC day.
 
-    fig = plt.figure(figsize=(12,10.0))
-    plt.imshow(status, origin='lower', aspect='auto', interpolation='nearest',
-          extent=[dt.datetime.utcfromtimestamp(start), dt.datetime.utcfromtimestamp(stop), -0.5, tot_wafers-0.5])
-    for y in np.arange(len(optics_tubes))*3:
-        plt.hlines(y-0.5, color='k',
-                   xmin=dt.datetime.utcfromtimestamp(start),
-                   xmax=dt.datetime.utcfromtimestamp(stop)
+    stop cuts the day short (for today, so the future is not idle).
+    """
+    if stop is None:
+        stop = day + 86400
+    obs_list, index, tags = load_day(platform, day)
+    return duty_seconds(
+        obs_list, index, tags, platform_targets(platform), day, stop,
+    )
+
+@st.cache_data(max_entries=5000, show_spinner=False)
+def completed_day_stats(platform, day):
+    """day_stats for a final day (day_is_final); those do not change, so
+    cache them."""
+    return day_stats(platform, day)
+
+def utc_days(start, stop):
+    """ctimes of the UTC midnights of the days overlapping [start, stop)."""
+    return np.arange(np.floor(start / 86400) * 86400, stop, 86400)
+
+def duty_table(platforms, start, stop):
+    """Seconds per category for every platform, target and UTC day.
+
+    Days the mirror is complete for (day_is_final) come from the cache;
+    later ones, and all of them while the mirror's sync is failing, are
+    recomputed, today only up to the current time. The 'seconds' column
+    is the length of the period each row covers.
+    """
+    now = dt.datetime.now(dt.timezone.utc).timestamp()
+    frames = []
+    for platform in platforms:
+        complete = obsdb_mirror.complete_until(platform)
+        for day in utc_days(start, min(stop, now)):
+            if day_is_final(day, complete):
+                seconds = completed_day_stats(platform, day)
+                length = 86400
+            elif day + 86400 <= now:
+                seconds = day_stats(platform, day)
+                length = 86400
+            else:
+                seconds = day_stats(platform, day, now)
+                length = now - day
+            df = pd.DataFrame(seconds, columns=categories)
+            df.insert(0, 'seconds', length)
+            df.insert(0, 'target', platform_targets(platform))
+            df.insert(0, 'day', timeaxis.to_datetime64(day, unit='s'))
+            df.insert(0, 'platform', platform)
+            frames.append(df)
+    if len(frames) == 0:
+        return pd.DataFrame(
+            columns=['platform', 'day', 'target', 'seconds'] + categories
         )
-    plt.yticks(np.arange(tot_wafers), labels, )
+    return pd.concat(frames, ignore_index=True)
 
+def duty_rollup(table, freq, by=('platform',)):
+    """Fraction of time per category, summed into periods of freq.
+
+    Seconds are summed over the days in each period (and over targets
+    unless 'target' is in by) before dividing by the summed period
+    lengths, so the fractions are exact rather than averages of averages.
+    """
+    keys = list(by) + [pd.Grouper(key='day', freq=freq)]
+    sums = table.groupby(keys)[['seconds'] + categories].sum()
+    fractions = sums[categories].div(sums['seconds'], axis=0)
+    # drop categories never seen in the range
+    return fractions.loc[:, (fractions > 0).any()]
+
+def lod_step(span):
+    """Finest level of detail (seconds) with at most LOD_MAX_BINS bins in span."""
+    for step in LOD_STEPS.values():
+        if span / step <= LOD_MAX_BINS:
+            return step
+    return max(LOD_STEPS.values())
+
+def timeline(platform, start, stop, step):
+    """Concatenated day tiles covering [start, stop) (ctimes), cut to range.
+
+    Returns:
+      ctimes of the bin starts, codes and duty (targets x bins).
+    """
+    first = np.floor(start / 86400) * 86400
+    days = np.arange(first, stop, 86400)
+    complete = obsdb_mirror.complete_until(platform)
+    tiles = [
+        completed_day_tile(platform, day, step)
+        if day_is_final(day, complete)
+        else day_tile(platform, day, step)
+        for day in days
+    ]
+    codes = np.concatenate([c for c, _ in tiles], axis=1)
+    duty = np.concatenate([d for _, d in tiles], axis=1)
+    ctimes = first + step*np.arange(codes.shape[1])
+    sel = (ctimes + step > start) & (ctimes < stop)
+    return ctimes[sel], codes[:, sel], duty[:, sel]
+
+def plot_timeline(platform, ctimes, codes, duty, step):
+    """Plotly heatmap of a timeline with one discrete colour per category."""
+    n = len(categories)
+    colorscale = []
+    for i, name in enumerate(categories):
+        c = mcolors.to_hex(colors[name])
+        colorscale += [[i/n, c], [(i+1)/n, c]]
+    fig = go.Figure(go.Heatmap(
+        z=codes,
+        x=timeaxis.to_datetime64(ctimes + step/2, unit='s'),
+        y=platform_targets(platform),
+        zmin=-0.5, zmax=n-0.5,
+        colorscale=colorscale,
+        showscale=False,
+        text=np.array(categories)[codes],
+        customdata=100*duty,
+        hovertemplate=(
+            "%{y} %{x|%Y-%m-%d %H:%M}<br>%{text}"
+            "<br>observed %{customdata:.0f}%<extra></extra>"
+        ),
+    ))
+    fig.update_layout(
+        title=platform,
+        height=200 + 12*codes.shape[0],
+        margin=dict(t=40, b=20),
+    )
     return fig
 
 now = dt.datetime.utcnow()
@@ -213,6 +354,12 @@ with left_column:
     )
 
     platforms = st.multiselect("Platforms", all_platforms, all_platforms)
+    # Weekly (behind its button) is the default, so opening the page
+    # does not query anything until a view is asked for
+    view = st.radio(
+        "View", ["Interactive", "Weekly", "Statistics"], index=1,
+        horizontal=True, key='history_view',
+    )
 
 
 with right_column:
@@ -229,7 +376,84 @@ st.write(
     """Note: book binding and obsdb building can lag by up to six hours during
     normal operations. Lags beyond that can indicate issues with data packaging."""
 )
-if st.button('Plot Observations'):
+for platform in platforms:
+    if obsdb_mirror.sync_error(platform) is not None:
+        st.warning(
+            f"Could not update the {platform} obsdb mirror "
+            f"({obsdb_mirror.sync_error(platform)}); showing the last "
+            "synced observations."
+        )
+if view == "Interactive":
+    t0 = dt.datetime.combine(
+        start_date, start_time, tzinfo=dt.timezone.utc
+    )
+    t1 = dt.datetime.combine(
+        end_date, end_time, tzinfo=dt.timezone.utc
+    )
+    if t1 <= t0:
+        st.error("End time must be after start time")
+        st.stop()
+    # Zooming re-runs the page with a narrower window, which switches to
+    # a finer level of detail while keeping the bins per row bounded.
+    v0, v1 = st.slider(
+        "Zoom", min_value=t0, max_value=t1, value=(t0, t1),
+        step=dt.timedelta(hours=1), format="YYYY-MM-DD HH:mm",
+        key='history_zoom',
+    )
+    if v1 <= v0:
+        v1 = v0 + dt.timedelta(hours=1)
+    start, stop = timeaxis.ctime(v0), timeaxis.ctime(v1)
+    step = lod_step(stop - start)
+    st.caption(
+        f"Bins of {[k for k, v in LOD_STEPS.items() if v == step][0]}, "
+        "coloured by the category observed for most of the bin."
+    )
+    st.pyplot(plot_colortable(colors, ncols=4, sort_colors=False))
+    for platform in platforms:
+        ctimes, codes, duty = timeline(platform, start, stop, step)
+        st.plotly_chart(
+            plot_timeline(platform, ctimes, codes, duty, step),
+            use_container_width=True,
+        )
+
+elif view == "Statistics":
+    t0 = dt.datetime.combine(
+        start_date, start_time, tzinfo=dt.timezone.utc
+    )
+    t1 = dt.datetime.combine(
+        end_date, end_time, tzinfo=dt.timezone.utc
+    )
+    rollup = st.radio(
+        "Rollup", ["Daily", "Weekly"], horizontal=True, key='history_rollup',
+    )
+    freq = {'Daily': 'D', 'Weekly': 'W-SUN'}[rollup]
+    st.caption(
+        "Fraction of time per category over whole UTC days overlapping the "
+        "range (today up to now), from obsdb start/stop times. Platform "
+        "rows sum over all wafers. Weeks run Monday to Sunday."
+    )
+    table = duty_table(platforms, timeaxis.ctime(t0), timeaxis.ctime(t1))
+    if len(table) == 0:
+        st.write("No completed time in range")
+        st.stop()
+    st.dataframe(
+        duty_rollup(table, freq).style.format("{:.1%}"),
+        use_container_width=True,
+    )
+    with st.expander("Per wafer"):
+        st.dataframe(
+            duty_rollup(table, freq, by=('platform', 'target'))
+            .style.format("{:.1%}"),
+            use_container_width=True,
+        )
+    st.download_button(
+        "Download daily seconds (CSV)",
+        table.to_csv(index=False),
+        file_name="observation_duty.csv",
+        mime="text/csv",
+    )
+
+elif st.button('Plot Observations'):
     t0 = dt.datetime.combine(
         start_date, start_time, tzinfo=dt.timezone.utc
     )
@@ -238,20 +462,26 @@ if st.button('Plot Observations'):
     )
     fig = plot_colortable(colors, ncols=4, sort_colors=False)
     st.pyplot(fig)
+    chunks = []
     for platform in platforms:
-        ctx = core.Context(f"/so/metadata/{platform}/contexts/basic.yaml")
         temp_t0 = t0
         temp_t1 = t0 + dt.timedelta(days=7)
         if temp_t1 > t1:
             temp_t1 = t1
         while temp_t0 < t1:
-            if "sat" in platform:
-                fig = plot_week_sat(ctx, temp_t0, temp_t1 )
-            elif "lat" in platform:
-                fig = plot_week_lat(ctx, temp_t0, temp_t1)
-            fig.suptitle(f"{platform}")
-            st.pyplot(fig)
+            chunks.append((platform, temp_t0, temp_t1))
             temp_t0 += dt.timedelta(days=7)
             temp_t1 += dt.timedelta(days=7)
             if temp_t1 > t1:
-                temp_t1 = t1
\ No newline at end of file
+                temp_t1 = t1
+
+    # Placeholders keep the platform/week order while chunks are filled
+    # in as soon as their worker finishes.
+    placeholders = [st.empty() for _ in chunks]
+    with ThreadPoolExecutor(max_workers=MAX_WORKERS) as pool:
+        futures = {
+            pool.submit(render_week, *chunk): i
+            for i, chunk in enumerate(chunks)
+        }
+        for future in as_completed(futures):
+            placeholders[futures[future]].image(future.result())
@@ -3,6 +3,7 @@ from functools import partial
 import yaml
 import os
 import numpy as np
+import pandas as pd
 from matplotlib import pyplot as plt
 import matplotlib.dates as mdates
 
@@ -12,21 +13,28 @@ from streamlit_ace import st_ace
 from streamlit_sortables import sort_items
 
 from schedlib import policies, core, utils
-from schedlib import rules as ru, source as src, instrument as inst
+from schedlib import rules as ru, instrument as inst
 
 from schedlib.policies.satp1 import make_geometry
 from schedlib.thirdparty import SunAvoidance
 
-from so3g.proj import quat, CelestialSightLine
-from sotodlib import coords, core as todlib_core
+from sotodlib import coords
 
 import jax.tree_util as tu
 
+import timeaxis
+import source_tracks
+import focal_plane
+import cal_search
+from trajectory import Trajectory, source_xieta, xieta_source_name
+
 """ How to run this in your own directory
 streamlit run src/Home.py --server.address=localhost --browser.gatherUsageStats=false --server.fileWatcherType=none --server.port 8075
 """;
 
 geometry = make_geometry()
+# focal_plane cache key for geometry
+PLATFORM = 'satp1'
 
 
 array_focus = {
@@ -55,70 +63,29 @@ array_focus = {
 
 SOURCES = ['Moon', 'Jupiter', 'Saturn', 'TauA']
 
-def tod_from_block( block, ndet=100 ):
-    # pretty sure these are in degrees
-    t, az, alt = block.get_az_alt()
+# detectors drawn per wafer ring, and most trajectory samples per scan
+# block sent through the sightline computation for plotting
+NDET = 100
+PLOT_SAMPLES = 2000
 
-    tod = todlib_core.AxisManager(
-        todlib_core.LabelAxis('dets', ['a%02i' % i for i in range(ndet)]),
-        todlib_core.OffsetAxis('samps', len(t))
+def plot_focal_plane(ax, traj, ndet=NDET):
+    roll = np.mean(traj.roll)
+    wafers = focal_plane.positions(
+        PLATFORM, geometry, roll, ndet=ndet
     )
-    tod.wrap_new('timestamps', ('samps', ))[:] = t
-
-    bs = todlib_core.AxisManager(tod.samps)
-    bs.wrap_new('az', ('samps', ))[:] = np.mod(az,360)* coords.DEG
-    bs.wrap_new('el', ('samps', ))[:] = az*0 + alt * coords.DEG
-    bs.wrap_new('roll', ('samps', ))[:] = az*0+block.boresight_angle*coords.DEG
-    tod.wrap('boresight', bs)
-
-    return tod
-
-def plot_focal_plane(ax, tod):
-    roll = np.mean(tod.boresight.roll)
-
-    for waf in geometry:
-        xi0, eta0 = geometry[waf]['center']
-        R = geometry[waf]['radius']
-        phi = np.arange(tod.dets.count) * 2*np.pi / tod.dets.count
-        qwafer = quat.rotation_xieta(xi0 * coords.DEG, eta0 * coords.DEG)
-        qdets = quat.rotation_xieta(R * coords.DEG * np.cos(phi),
-                                    R * coords.DEG * np.sin(phi))
-        if roll != 0:
-            q_bore_rot = quat.euler(2, -roll )#* coords.DEG)
-            qwafer = q_bore_rot * qwafer
-            qdets = q_bore_rot * qdets
-
-        xi_c, eta_c, _ = quat.decompose_xieta(qwafer )
-        xid, etad, _ = quat.decompose_xieta(qwafer * qdets)
-
+    for waf, (xi_c, eta_c, xid, etad) in wafers.items():
         ax.scatter( xid, etad, marker='.')
         ax.text( xi_c, eta_c, waf)
 
 
-def get_focal_plane(tod):
-    xid_list = []
-    etad_list = []
-
-    roll = np.mean(tod.boresight.roll)
-
-    for waf in geometry:
-        xi0, eta0 = geometry[waf]['center']
-        R = geometry[waf]['radius']
-        phi = np.arange(tod.dets.count) * 2*np.pi / tod.dets.count
-        qwafer = quat.rotation_xieta(xi0 * coords.DEG, eta0 * coords.DEG)
-        qdets = quat.rotation_xieta(R * coords.DEG * np.cos(phi),
-                                    R * coords.DEG * np.sin(phi))
-        if roll != 0:
-            q_bore_rot = quat.euler(2, -roll * coords.DEG)
-            qwafer = q_bore_rot * qwafer
-            qdets = q_bore_rot * qdets
-
-        xid, etad, _ = quat.decompose_xieta(qwafer * qdets)
-        xid_list.append(xid)
-        etad_list.append(etad)
-
-    xid = np.concatenate(xid_list)
-    etad = np.concatenate(etad_list)
+def get_focal_plane(traj, ndet=NDET):
+    roll = np.mean(traj.roll)
+    # this has always converted the (radian) roll by DEG again
+    wafers = focal_plane.positions(
+        PLATFORM, geometry, roll * coords.DEG, ndet=ndet
+    )
+    xid = np.concatenate([w[2] for w in wafers.values()])
+    etad = np.concatenate([w[3] for w in wafers.values()])
     return xid, etad
 
 now = dt.datetime.utcnow()
@@ -185,27 +152,20 @@ if st.button('Plot Sources'):
 
     fig = plt.figure(figsize=(8,3.75))
     ax = fig.add_subplot(111)
-    sun = SunAvoidance(
-        min_angle=sun_avoid_angle, 
-        min_sun_time=sun_avoid_time*60
-    )
-
     for c, source in enumerate(sources):
-        src_blocks = src.source_gen_seq(source.lower(), t0, t1)
-        for block in src_blocks:
-            t, az, alt = block.get_az_alt(time_step=30)
-            plt.plot([dt.datetime.utcfromtimestamp(x) for x in t], alt, f'C{c}-', alpha=0.3)
-
-        src_blocks = core.seq_flatten(sun.apply(src_blocks))
-
-        for b,block in enumerate(src_blocks):
-            if b == 0:
-                lab=source
-            else:
-                lab=None
-            t, az, alt = block.get_az_alt(time_step=30)
-            plt.plot([dt.datetime.utcfromtimestamp(x) for x in t], 
-                alt, f'C{c}-', label=lab)
+        # one track per source block; the sun cut is a mask over it
+        lab = source
+        for t, az, alt in source_tracks.source_track(
+            source, t0, t1, time_step=30
+        ):
+            safe = source_tracks.sun_safe_mask(
+                t, az, alt, sun_avoid_angle, sun_avoid_time*60
+            )
+            times = timeaxis.to_datetime64(t)
+            plt.plot(times, alt, f'C{c}-', alpha=0.3)
+            if safe.any():
+                plt.plot(times, np.where(safe, alt, np.nan), f'C{c}-', label=lab)
+                lab = None
 
     locator = mdates.AutoDateLocator()
     formatter = mdates.ConciseDateFormatter(locator)
@@ -303,7 +263,7 @@ with st.form("my data",clear_on_submit=False):
         min_dur_rule = ru.make_rule(
             'min-duration', **{'min_duration': min_scan_duration*60},
         )
-        src_blocks = sun(src.source_gen_seq(source.lower(), t0, t1))
+        src_blocks = sun(source_tracks.source_blocks(source, t0, t1))
         #st.write(f"Source Blocks {src_blocks}")
 
         array_info = inst.array_info_from_query(geometry, target_str)
@@ -320,33 +280,106 @@ with st.form("my data",clear_on_submit=False):
         scan_blocks = core.seq_flatten(min_dur_rule(sun(scan_blocks)))
         st.write(f"Scan Blocks {scan_blocks}")
 
-        for block in scan_blocks:
+        source = xieta_source_name(source)
+
+        # one sightline pass for all blocks, split back per block
+        trajs = [
+            Trajectory.from_block(block, max_samples=PLOT_SAMPLES)
+            for block in scan_blocks
+        ]
+        src_tracks = source_xieta(trajs, source, weather='vacuum')
+
+        for block, traj, (xip, etap) in zip(scan_blocks, trajs, src_tracks):
             fig = plt.figure(figsize=(5,3.75))
             ax = fig.add_subplot(111)
-        
-            tod = tod_from_block(block)
-            #xi_fp, eta_fp = get_focal_plane(tod)
+
+            #xi_fp, eta_fp = get_focal_plane(traj)
             #ax.scatter(xi_fp, eta_fp, c='k', alpha=0.5)
-            plot_focal_plane(ax, tod)
-
-            csl = CelestialSightLine.az_el(
-                tod.timestamps, tod.boresight.az, tod.boresight.el, weather='vacuum')
-            ra, dec, _ = quat.decompose_lonlat(csl.Q)
-            if source.lower() == 'taua':
-                x = [
-                    x for x in coords.planets.SOURCE_LIST if isinstance(x, tuple) and x[0] =='tauA'
-                ][0]
-                source = f"J{x[1]}+{x[2]}"
-
-            src_path = coords.planets.SlowSource.for_named_source(
-                  source, tod.timestamps.mean()
-            )
-            ra0, dec0 = src_path.ra, src_path.dec
-            ra0 = (ra0 - ra[0]) % (2 * np.pi) + ra[0]
-            # Un-rotate the planet into boresight coords.
-            xip, etap, _ = quat.decompose_xieta(
-                ~csl.Q * quat.rotation_lonlat(ra0, dec0)
-            )
+            plot_focal_plane(ax, traj)
+
             ax.plot(xip, etap, alpha=0.5)
             ax.set_title( block.t0.isoformat() + f'\n{block.az} throw:{block.throw}' )
-            st.pyplot(fig)
\ No newline at end of file
+            st.pyplot(fig)
+
+with st.form("cal search", clear_on_submit=False):
+
+    st.title("Calibration Search")
+    st.write(
+        "Evaluates every source, array focus, boresight and elevation "
+        "combination with the sun avoidance and minimum duration rules. "
+        "Uses the time range and sun avoidance of the last plotted sources."
+    )
+    col1, col2 = st.columns(2)
+    with col1:
+        search_sources = st.multiselect("Sources", SOURCES, SOURCES)
+        search_foci = st.multiselect(
+            "Array Foci",
+            list(array_focus[0]),
+            list(array_focus[0]),
+        )
+    with col2:
+        search_boresights = st.multiselect(
+            "Boresights (deg)", list(array_focus), list(array_focus),
+        )
+        search_elevations = st.multiselect(
+            "Elevations (deg)", list(range(48, 81)), [50, 60],
+        )
+        search_min_duration = st.number_input(
+            "Minimum Scan Duration (min)",
+            min_value = 0,
+            max_value = 60,
+            value=10,
+            step=1,
+            key='search_min_duration',
+        )
+
+    run_search = st.form_submit_button("Search")
+    if run_search:
+        timing = st.session_state['timing']
+        configs = [
+            {
+                'source': source,
+                'focus': focus,
+                'target': array_focus[boresight][focus],
+                'boresight': boresight,
+                'elevation': elevation,
+                't0': timing['t0'],
+                't1': timing['t1'],
+                'sun_avoid_angle': timing.get('sun_avoid_angle', sun_avoid_angle),
+                'sun_avoid_time': timing.get('sun_avoid_time', sun_avoid_time),
+                'min_scan_duration': search_min_duration,
+            }
+            for source in search_sources
+            for focus in search_foci
+            for boresight in search_boresights
+            for elevation in search_elevations
+        ]
+
+        # rows are ranked longest scan first and redrawn as workers finish
+        progress = st.progress(0.0)
+        table = st.empty()
+        rows = []
+        for i, (config, result, error) in enumerate(
+            cal_search.search(configs)
+        ):
+            progress.progress(
+                (i + 1) / len(configs),
+                text=f"{i + 1}/{len(configs)} configurations",
+            )
+            if error is not None:
+                st.warning(
+                    f"{config['source']} {config['focus']} "
+                    f"{config['boresight']} {config['elevation']}: {error}"
+                )
+                continue
+            rows.extend(result)
+            if rows:
+                table.dataframe(
+                    pd.DataFrame(rows).sort_values(
+                        ['duration (min)', 'start'], ascending=[False, True],
+                    ),
+                    hide_index=True,
+                    use_container_width=True,
+                )
+        if not rows:
+            table.write("No feasible scans found")
@@ -7,91 +7,58 @@ import pandas as pd
 import streamlit as st
 
 from schedlib import core
-from schedlib import rules as ru, source as src, instrument as inst
+from schedlib import rules as ru, instrument as inst
 
 from schedlib.policies.lat import make_geometry
 from schedlib.thirdparty import SunAvoidance
 
-from so3g.proj import quat, CelestialSightLine
-from sotodlib import coords, core as todlib_core
+from sotodlib import coords
 
 import jax.tree_util as tu
 
+import timeaxis
+import source_tracks
+import focal_plane
+import fixed_sources
+import source_catalog
+from trajectory import Trajectory, source_xieta, xieta_source_name
+
 """ How to run this in your own directory
 streamlit run src/Home.py --server.address=localhost --browser.gatherUsageStats=false --server.fileWatcherType=none --server.port 8075
 """;
 
 geometry = make_geometry()
+# focal_plane cache key for geometry
+PLATFORM = 'lat'
 
 
 SOURCES = [
     'Moon', 'Jupiter', 'Saturn', 'TauA', 'Uranus', 'Neptune', 'Mars', 'galcenter', 'Table'
 ]
 
-def tod_from_block( block, ndet=100 ):
-    # pretty sure these are in degrees
-    t, az, alt = block.get_az_alt()
+# detectors drawn per wafer ring, and most trajectory samples per scan
+# block sent through the sightline computation for plotting
+NDET = 100
+PLOT_SAMPLES = 2000
 
-    tod = todlib_core.AxisManager(
-        todlib_core.LabelAxis('dets', ['a%02i' % i for i in range(ndet)]),
-        todlib_core.OffsetAxis('samps', len(t))
+def plot_focal_plane(ax, traj, ndet=NDET):
+    roll = np.mean(traj.roll)
+    wafers = focal_plane.positions(
+        PLATFORM, geometry, roll, ndet=ndet
     )
-    tod.wrap_new('timestamps', ('samps', ))[:] = t
-
-    bs = todlib_core.AxisManager(tod.samps)
-    bs.wrap_new('az', ('samps', ))[:] = np.mod(az,360)* coords.DEG
-    bs.wrap_new('el', ('samps', ))[:] = az*0 + alt * coords.DEG
-    bs.wrap_new('roll', ('samps', ))[:] = az*0+block.boresight_angle*coords.DEG
-    tod.wrap('boresight', bs)
-
-    return tod
-
-def plot_focal_plane(ax, tod):
-    roll = np.mean(tod.boresight.roll)
-
-    for waf in geometry:
-        xi0, eta0 = geometry[waf]['center']
-        R = geometry[waf]['radius']
-        phi = np.arange(tod.dets.count) * 2*np.pi / tod.dets.count
-        qwafer = quat.rotation_xieta(xi0 * coords.DEG, eta0 * coords.DEG)
-        qdets = quat.rotation_xieta(R * coords.DEG * np.cos(phi),
-                                    R * coords.DEG * np.sin(phi))
-        if roll != 0:
-            q_bore_rot = quat.euler(2, -roll )#* coords.DEG)
-            qwafer = q_bore_rot * qwafer
-            qdets = q_bore_rot * qdets
-
-        xi_c, eta_c, _ = quat.decompose_xieta(qwafer )
-        xid, etad, _ = quat.decompose_xieta(qwafer * qdets)
-
+    for waf, (xi_c, eta_c, xid, etad) in wafers.items():
         ax.scatter( xid, etad, marker='.')
         ax.text( xi_c, eta_c, waf)
 
 
-def get_focal_plane(tod):
-    xid_list = []
-    etad_list = []
-
-    roll = np.mean(tod.boresight.roll)
-
-    for waf in geometry:
-        xi0, eta0 = geometry[waf]['center']
-        R = geometry[waf]['radius']
-        phi = np.arange(tod.dets.count) * 2*np.pi / tod.dets.count
-        qwafer = quat.rotation_xieta(xi0 * coords.DEG, eta0 * coords.DEG)
-        qdets = quat.rotation_xieta(R * coords.DEG * np.cos(phi),
-                                    R * coords.DEG * np.sin(phi))
-        if roll != 0:
-            q_bore_rot = quat.euler(2, -roll * coords.DEG)
-            qwafer = q_bore_rot * qwafer
-            qdets = q_bore_rot * qdets
-
-        xid, etad, _ = quat.decompose_xieta(qwafer * qdets)
-        xid_list.append(xid)
-        etad_list.append(etad)
-
-    xid = np.concatenate(xid_list)
-    etad = np.concatenate(etad_list)
+def get_focal_plane(traj, ndet=NDET):
+    roll = np.mean(traj.roll)
+    # this has always converted the (radian) roll by DEG again
+    wafers = focal_plane.positions(
+        PLATFORM, geometry, roll * coords.DEG, ndet=ndet
+    )
+    xid = np.concatenate([w[2] for w in wafers.values()])
+    etad = np.concatenate([w[3] for w in wafers.values()])
     return xid, etad
 
 now = dt.datetime.utcnow()
@@ -180,12 +147,15 @@ new_sources = pd.DataFrame(
 added_sources = st.data_editor(new_sources, num_rows="dynamic")
 
 if st.button('Plot Sources'):
+    # table sources live in this session's catalog, not in schedlib
+    catalog = source_catalog.session_catalog(st.session_state)
+    catalog.clear()
     if "Table" in sources:
         sources.pop( sources.index("Table"))
         for i in range(len(added_sources.name)):
             if not added_sources.add_to_plot[i]:
                 continue
-            src.add_fixed_source(
+            catalog.add(
                 added_sources.name[i], 
                 added_sources.ra[i], 
                 added_sources.dec[i]
@@ -213,43 +183,51 @@ if st.button('Plot Sources'):
     fig = plt.figure(figsize=(8,6.75))
     ax = fig.add_subplot(211)
     ax2 = fig.add_subplot(212)
-    sun = SunAvoidance(
-        min_angle=sun_avoid_angle, 
-        min_sun_time=sun_avoid_time*60
-    )
-
+    # fixed sources that never reach the elevation filter: name -> max el
+    skipped = {}
     for c, source in enumerate(sources):
         if c > 10:
             ls = '--'
         else:
             ls = '-'
         cnum = c%10
-        src_blocks = src.source_gen_seq(source.lower(), t0, t1)
-        
-        for block in src_blocks:
-            t, az, alt = block.get_az_alt(time_step=30)
-            if np.max(alt) < filter_elevation:
-                print(f"Source {source} skipped, max el = {np.max(alt)}")
+        radec = catalog.radec(source)
+        if radec is not None:
+            # fixed sources: reject or narrow the range analytically
+            # before generating any tracks
+            visible = fixed_sources.visible_range(
+                *radec, t0.timestamp(), t1.timestamp(), filter_elevation,
+            )
+            if visible is None:
+                skipped[source] = fixed_sources.transit_elevation(radec[1])
                 continue
-            ax.plot(
-                [dt.datetime.utcfromtimestamp(x) for x in t], 
-                alt, f'C{cnum}{ls}', alpha=0.3
+            src_t0, src_t1 = (
+                dt.datetime.fromtimestamp(x, dt.timezone.utc) for x in visible
             )
-        
-        src_blocks = core.seq_flatten(sun.apply(src_blocks))
-
-        for b,block in enumerate(src_blocks):
-            if b == 0:
-                lab=source
-            else:
-                lab=None
-            t, az, alt = block.get_az_alt(time_step=30)
+            tracks = source_tracks.fixed_source_track(
+                source, *radec, src_t0, src_t1,
+                min_el=filter_elevation, time_step=30,
+            )
+        else:
+            tracks = source_tracks.source_track(source, t0, t1, time_step=30)
+        # one track per source block; the sun cut is a mask over it
+        lab = source
+        for t, az, alt in tracks:
             if np.max(alt) < filter_elevation:
                 print(f"Source {source} skipped, max el = {np.max(alt)}")
                 continue
-            ax.plot([dt.datetime.utcfromtimestamp(x) for x in t], 
-                alt, f'C{cnum}{ls}', label=lab)
-            ax2.plot(np.mod(az[::120],360), alt[::120], f'C{cnum}{ls}o', label=lab)
+            safe = source_tracks.sun_safe_mask(
+                t, az, alt, sun_avoid_angle, sun_avoid_time*60
+            )
+            times = timeaxis.to_datetime64(t)
+            ax.plot(times, alt, f'C{cnum}{ls}', alpha=0.3)
+            if not safe.any() or np.max(alt[safe]) < filter_elevation:
+                continue
+            ax.plot(times, np.where(safe, alt, np.nan),
+                f'C{cnum}{ls}', label=lab)
+            every = np.flatnonzero(safe)[::120]
+            ax2.plot(np.mod(az[every],360), alt[every], f'C{cnum}{ls}o', label=lab)
+            lab = None
 
     locator = mdates.AutoDateLocator()
     formatter = mdates.ConciseDateFormatter(locator)
@@ -271,6 +249,71 @@ if st.button('Plot Sources'):
     ax2.set_xlabel("Azimuth (deg)")
     ax2.set_ylabel("Elevation (deg)")
     st.pyplot(fig)
+    if skipped:
+        st.caption(
+            "Not shown, below the elevation filter in this range: " + ", ".join(
+                f"{name} (transits at {el:.1f} deg)"
+                for name, el in skipped.items()
+            )
+        )
+
+st.header("Catalog Visibility")
+st.write(
+    "Visibility of a fixed-source catalog over the selected time range: "
+    "above the elevation filter and outside the sun avoidance angle. "
+    "Upload a CSV with name, ra and dec columns (deg), or the table "
+    "above is used. Positions are geometric (no refraction or "
+    "precession), on a one minute grid."
+)
+catalog_file = st.file_uploader("Source catalog (CSV)", type="csv")
+catalog_sun = st.checkbox("Apply sun avoidance angle", value=True)
+if st.button("Compute Visibility"):
+    catalog = (
+        pd.read_csv(catalog_file) if catalog_file is not None
+        else added_sources
+    )
+    missing = {'name', 'ra', 'dec'} - set(catalog.columns)
+    if missing:
+        st.error(f"Catalog is missing columns {', '.join(sorted(missing))}")
+        st.stop()
+    catalog = catalog.copy()
+    for c in ['ra', 'dec']:
+        catalog[c] = pd.to_numeric(catalog[c], errors='coerce')
+    bad = catalog[['ra', 'dec']].isna().any(axis=1)
+    if bad.any():
+        rows = ', '.join(str(i + 1) for i in np.flatnonzero(bad))
+        st.error(
+            f"Skipped {bad.sum()} source(s) with missing or non-numeric "
+            f"ra or dec (rows {rows})"
+        )
+        catalog = catalog[~bad]
+    cat_t0 = dt.datetime.combine(start_date, start_time, tzinfo=dt.timezone.utc)
+    cat_t1 = dt.datetime.combine(end_date, end_time, tzinfo=dt.timezone.utc)
+    if cat_t1 <= cat_t0:
+        st.error("End time must be after start time")
+        st.stop()
+    summary, windows = fixed_sources.catalog_visibility(
+        catalog['name'].astype(str), catalog['ra'], catalog['dec'],
+        cat_t0.timestamp(), cat_t1.timestamp(), filter_elevation,
+        sun_angle=sun_avoid_angle if catalog_sun else None,
+    )
+    st.write(
+        f"{int((summary['windows'] > 0).sum())} of {len(summary)} sources "
+        "visible"
+    )
+    st.dataframe(
+        summary.sort_values('hours visible', ascending=False),
+        hide_index=True,
+        use_container_width=True,
+    )
+    with st.expander("Visibility windows"):
+        st.dataframe(windows, hide_index=True, use_container_width=True)
+    st.download_button(
+        "Download windows (CSV)",
+        windows.to_csv(index=False),
+        file_name="catalog_windows.csv",
+        mime="text/csv",
+    )
 
 with st.form("my data",clear_on_submit=False):
 
@@ -384,7 +427,7 @@ with st.form("my data",clear_on_submit=False):
         min_dur_rule = ru.make_rule(
             'min-duration', **{'min_duration': min_scan_duration*60},
         )
-        src_blocks = sun(src.source_gen_seq(source.lower(), t0, t1))
+        src_blocks = sun(source_tracks.source_blocks(source, t0, t1))
         #st.write(f"Source Blocks {src_blocks}")
 
         array_info = inst.array_info_from_query(geometry, target_str)
@@ -401,33 +444,23 @@ with st.form("my data",clear_on_submit=False):
         scan_blocks = core.seq_flatten(min_dur_rule(sun(scan_blocks)))
         st.write(f"Scan Blocks {scan_blocks}")
 
-        for block in scan_blocks:
+        source = xieta_source_name(source)
+
+        # one sightline pass for all blocks, split back per block
+        trajs = [
+            Trajectory.from_block(block, max_samples=PLOT_SAMPLES)
+            for block in scan_blocks
+        ]
+        src_tracks = source_xieta(trajs, source, weather='vacuum')
+
+        for block, traj, (xip, etap) in zip(scan_blocks, trajs, src_tracks):
             fig = plt.figure(figsize=(5,3.75))
             ax = fig.add_subplot(111)
 
-            tod = tod_from_block(block)
-            #xi_fp, eta_fp = get_focal_plane(tod)
+            #xi_fp, eta_fp = get_focal_plane(traj)
             #ax.scatter(xi_fp, eta_fp, c='k', alpha=0.5)
-            plot_focal_plane(ax, tod)
-
-            csl = CelestialSightLine.az_el(
-                tod.timestamps, tod.boresight.az, tod.boresight.el, weather='vacuum')
-            ra, dec, _ = quat.decompose_lonlat(csl.Q)
-            if source.lower() == 'taua':
-                x = [
-                    x for x in coords.planets.SOURCE_LIST if isinstance(x, tuple) and x[0] =='tauA'
-                ][0]
-                source = f"J{x[1]}+{x[2]}"
-
-            src_path = coords.planets.SlowSource.for_named_source(
-                  source, tod.timestamps.mean()
-            )
-            ra0, dec0 = src_path.ra, src_path.dec
-            ra0 = (ra0 - ra[0]) % (2 * np.pi) + ra[0]
-            # Un-rotate the planet into boresight coords.
-            xip, etap, _ = quat.decompose_xieta(
-                ~csl.Q * quat.rotation_lonlat(ra0, dec0)
-            )
+            plot_focal_plane(ax, traj)
+
             ax.plot(xip, etap, alpha=0.5)
             ax.set_title( block.t0.isoformat() + f'\n{block.az} throw:{block.throw}' )
             st.pyplot(fig)
\ No newline at end of file
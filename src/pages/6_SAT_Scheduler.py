@@ -25,6 +25,8 @@ import streamlit as st
 from matplotlib.backends.backend_agg import RendererAgg
 from threading import RLock
 
+import timeaxis
+
 logger = u.init_logger(__name__)
 
 _lock = RLock()
@@ -86,9 +88,11 @@ def build_table(t0, t1, cfg, seq, cmds, state, platform):
         "other": "#FFFFFF",
     }
 
-    times = pd.date_range(t0, t1, freq='1s')
+    ctimes = timeaxis.ctime_grid(
+        u.str2datetime(t0), u.str2datetime(t1), 1, endpoint=True
+    )
+    times = timeaxis.to_datetime64(ctimes, unit='s')
     z = np.full((1, len(times)), -1, dtype=int)
-    hover_text = np.full((1, len(times)), '', dtype=object)
 
     names = list(np.unique(df['name']))
     name_to_idx = {name: i for i, name in enumerate(names)}
@@ -101,14 +105,18 @@ def build_table(t0, t1, cfg, seq, cmds, state, platform):
         colorscale.append([(i + 1) / n, c])
 
     for _, row in df.iterrows():
-        start_idx = np.searchsorted(times, row['#   Start Time UTC'], side='left')
-        stop_idx = np.searchsorted(times, row['Stop Time UTC'], side='right')
+        start_idx = np.searchsorted(
+            ctimes, timeaxis.ctime(row['#   Start Time UTC']), side='left'
+        )
+        stop_idx = np.searchsorted(
+            ctimes, timeaxis.ctime(row['Stop Time UTC']), side='right'
+        )
         name = row['name'] if row['name'] in name_to_idx else 'other'
         idx = name_to_idx[name]
         z[0, start_idx:stop_idx] = idx
-        for i in range(start_idx, stop_idx):
-            hover_text[0, i] = f"{name}<br>{times[i].strftime('%Y-%m-%d %H:%M:%S')}"
 
+    # z == -1 (nothing scheduled) picks up the trailing ''
+    hover_text = np.array(names + [''])[z]
     z = np.where(z == -1, np.nan, z)
 
     ys = ["Operations"]
@@ -126,7 +134,7 @@ def build_table(t0, t1, cfg, seq, cmds, state, platform):
             x=times,
             y=ys,
             text=hover_text,
-            hoverinfo="text",
+            hovertemplate="%{text}<br>%{x|%Y-%m-%d %H:%M:%S}<extra></extra>",
             colorscale=colorscale,
             colorbar=dict(
                 tickvals=list(range(len(names))),
@@ -0,0 +1,81 @@
+"""Per-session fixed-source catalogs layered over schedlib's sources.
+
+``src.add_fixed_source`` adds to a list that is global to the server
+process, so sources added by one user showed up for everyone and the
+list only grew. Pages keep their fixed sources in a SourceCatalog in
+``st.session_state`` instead, and compute their tracks without touching
+schedlib (``source_tracks.fixed_source_track``, cached by name and
+position so identical sources from different sessions share them).
+
+Only the LAT Scheduler, whose policy looks calibration targets up by
+name inside schedlib, registers sources globally, through
+register_for_schedlib, which adds each (name, position) at most once.
+"""
+from threading import RLock
+
+from schedlib import source as src
+
+_lock = RLock()
+# sources this server added to schedlib's list: name -> (ra, dec)
+_registered = {}
+
+
+class SourceCatalog:
+    """Fixed sources (name -> ra, dec in degrees) of one session."""
+
+    def __init__(self, sources=None):
+        self._sources = {}
+        for name, (ra, dec) in (sources or {}).items():
+            self.add(name, ra, dec)
+
+    def add(self, name, ra, dec):
+        self._sources[str(name)] = (float(ra), float(dec))
+
+    def remove(self, name):
+        self._sources.pop(name, None)
+
+    def clear(self):
+        self._sources.clear()
+
+    def __contains__(self, name):
+        return name in self._sources
+
+    def __len__(self):
+        return len(self._sources)
+
+    def names(self):
+        return list(self._sources)
+
+    def radec(self, name):
+        """(ra, dec) of a catalog source, or None for other names."""
+        return self._sources.get(name)
+
+
+def session_catalog(session_state, key='source_catalog'):
+    """The SourceCatalog stored in session_state, created if needed."""
+    if key not in session_state:
+        session_state[key] = SourceCatalog()
+    return session_state[key]
+
+
+def register_for_schedlib(name, ra, dec):
+    """Make a fixed source known to schedlib by name, idempotently.
+
+    Built-in names are left alone. Re-registering a name with the same
+    position does nothing; a different position raises ValueError, as
+    the global list can only hold one position per name.
+    """
+    radec = (float(ra), float(dec))
+    with _lock:
+        if name in _registered:
+            if _registered[name] != radec:
+                raise ValueError(
+                    f"Source {name} is already registered at "
+                    f"ra={_registered[name][0]}, dec={_registered[name][1]}; "
+                    "use a different name for a different position"
+                )
+            return
+        if name in src.get_source_list():
+            return
+        src.add_fixed_source(name=name, ra=ra, dec=dec, ra_units='deg')
+        _registered[name] = radec
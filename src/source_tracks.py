@@ -0,0 +1,224 @@
+"""Process-wide cache of source blocks and az/el tracks for the planners.
+
+``src.source_gen_seq`` and ``block.get_az_alt`` are the slow part of the
+source planner pages, and their results only depend on the source and
+the time range. They are kept here in a least-recently-used cache shared
+by every session and bounded by memory (``SOURCE_TRACK_CACHE_MB``).
+
+Tracks are computed over whole UTC days and cut to the requested range,
+so changing the start or stop time within a day (or only the sun
+avoidance parameters or the calibration target) reuses the same entry.
+Cached values are shared: the arrays are read-only and the blocks must
+not be modified.
+"""
+import os
+from collections import OrderedDict
+import datetime as dt
+from threading import RLock
+
+import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
+from schedlib import source as src
+
+import ephemeris
+import fixed_sources
+
+CACHE_BYTES = int(os.environ.get("SOURCE_TRACK_CACHE_MB", 256)) * 2**20
+# nominal size charged for anything that is not a numpy array (blocks)
+OBJECT_BYTES = 1024
+# track samples per chunk in sun_safe_mask, bounds its memory use
+SUN_CHUNK = 4096
+
+_lock = RLock()
+_cache = OrderedDict()
+_cache_bytes = 0
+
+
+def _nbytes(value):
+    if isinstance(value, np.ndarray):
+        return value.nbytes
+    if isinstance(value, (list, tuple)):
+        return sum(_nbytes(v) for v in value)
+    return OBJECT_BYTES
+
+
+def _freeze(value):
+    if isinstance(value, np.ndarray):
+        value.setflags(write=False)
+    elif isinstance(value, (list, tuple)):
+        for v in value:
+            _freeze(v)
+    return value
+
+
+def _cached(key, compute):
+    """Value for key, computing and storing it on a miss.
+
+    The computation runs outside the lock so sessions do not wait on
+    each other's ephemerides; two sessions missing the same key at once
+    both compute it and the first result is kept.
+    """
+    global _cache_bytes
+    with _lock:
+        if key in _cache:
+            _cache.move_to_end(key)
+            return _cache[key][0]
+
+    value = _freeze(compute())
+    size = _nbytes(value)
+    with _lock:
+        if key in _cache:
+            _cache.move_to_end(key)
+            return _cache[key][0]
+        _cache[key] = (value, size)
+        _cache_bytes += size
+        while _cache_bytes > CACHE_BYTES and len(_cache) > 1:
+            _, (_, old_size) = _cache.popitem(last=False)
+            _cache_bytes -= old_size
+    return value
+
+
+def cache_info():
+    """Number of entries and bytes held by the cache."""
+    with _lock:
+        return len(_cache), _cache_bytes
+
+
+def clear():
+    global _cache_bytes
+    with _lock:
+        _cache.clear()
+        _cache_bytes = 0
+
+
+def _day_bounds(t0, t1):
+    d0 = t0.replace(hour=0, minute=0, second=0, microsecond=0)
+    d1 = t1.replace(hour=0, minute=0, second=0, microsecond=0)
+    if d1 < t1:
+        d1 += dt.timedelta(days=1)
+    return d0, d1
+
+
+def source_blocks(source, t0, t1):
+    """Cached ``src.source_gen_seq(source.lower(), t0, t1)``.
+
+    Args:
+      source (str): source name, as in the planners' source lists.
+      t0, t1 (datetime): time range.
+    """
+    key = ('blocks', source.lower(), t0, t1)
+    return _cached(key, lambda: src.source_gen_seq(source.lower(), t0, t1))
+
+
+def _cut(day_tracks, t0, t1):
+    c0, c1 = t0.timestamp(), t1.timestamp()
+    tracks = []
+    for t, az, alt in day_tracks:
+        i0 = np.searchsorted(t, c0, side='left')
+        i1 = np.searchsorted(t, c1, side='right')
+        if i1 > i0:
+            tracks.append((t[i0:i1], az[i0:i1], alt[i0:i1]))
+    return tracks
+
+
+def source_track(source, t0, t1, time_step=30):
+    """Az/el track of source between t0 and t1, one entry per source block.
+
+    The tracks of the whole UTC days covering [t0, t1] are cached and
+    cut to the range (samples keep the whole-day block phase).
+
+    Returns:
+      list of (t, az, alt) read-only arrays as from ``block.get_az_alt``,
+      with t in ctime and az, alt in degrees.
+    """
+    d0, d1 = _day_bounds(t0, t1)
+
+    def compute():
+        return [
+            tuple(np.asarray(x) for x in block.get_az_alt(time_step=time_step))
+            for block in source_blocks(source, d0, d1)
+        ]
+
+    day_tracks = _cached(('track', source.lower(), d0, d1, time_step), compute)
+    return _cut(day_tracks, t0, t1)
+
+
+def _high_passes(ra, dec, t0, t1, min_el):
+    """Parts of [t0, t1] (ctimes) within PASS_MARGIN of the source being
+    above min_el - EL_MARGIN, merged where they overlap."""
+    passes = []
+    for a, b in fixed_sources.windows_above(
+        ra, dec, t0, t1, min_el - fixed_sources.EL_MARGIN
+    ):
+        a = max(t0, a - fixed_sources.PASS_MARGIN)
+        b = min(t1, b + fixed_sources.PASS_MARGIN)
+        if passes and a <= passes[-1][1]:
+            passes[-1] = (passes[-1][0], b)
+        else:
+            passes.append((a, b))
+    return passes
+
+
+def fixed_source_track(name, ra, dec, t0, t1, min_el=0, time_step=30):
+    """Az/el track of a fixed source, one entry per pass above min_el.
+
+    Like source_track, but for a source given by position (e.g. from a
+    session's SourceCatalog) rather than one registered with schedlib.
+    Only the passes that reach min_el (deg) are computed, widened by the
+    margins of ``fixed_sources`` so the exact elevation cut can still be
+    applied to the track. The passes come from the geometric model of
+    ``fixed_sources``; positions along them are apparent ones from ephem
+    (J2000 ra, dec precessed and refracted), with a body and observer
+    per call. Cached on (name, ra, dec), so the same source from
+    different sessions shares its tracks.
+    """
+    d0, d1 = _day_bounds(t0, t1)
+    ra, dec = float(ra), float(dec)
+
+    def compute():
+        tracks = []
+        for a, b in _high_passes(
+            ra, dec, d0.timestamp(), d1.timestamp(), min_el
+        ):
+            t = np.arange(a, b, time_step)
+            az, alt = ephemeris.ephem_az_el(
+                ephemeris.fixed_body(ra, dec), t
+            )
+            tracks.append((t, az, alt))
+        return tracks
+
+    day_tracks = _cached(
+        ('fixed', name, ra, dec, d0, d1, min_el, time_step), compute
+    )
+    return _cut(day_tracks, t0, t1)
+
+
+def sun_safe_mask(t, az, alt, min_angle, min_sun_time):
+    """True where a track sample survives sun avoidance.
+
+    A sample is cut if the Sun comes within min_angle (deg) of its
+    az/alt at any time from the sample to min_sun_time seconds later,
+    i.e. if pointing there would not be safe for min_sun_time. This is
+    the rule schedlib's SunAvoidance applies to blocks, evaluated on the
+    already computed track (t must be evenly spaced, as from
+    ``get_az_alt``) with ``ephemeris.sun_az_el`` instead of
+    re-generating the cut blocks, so segment edges agree with it to
+    about one sample.
+    """
+    t = np.asarray(t, dtype=float)
+    if len(t) == 0:
+        return np.zeros(0, dtype=bool)
+    step = t[1] - t[0] if len(t) > 1 else 1.0
+    width = int(np.ceil(min_sun_time / step)) + 1
+    sun = ephemeris.unit_vector(*ephemeris.sun_az_el(t[0] + step*np.arange(len(t) + width - 1)))
+    cos_min = np.cos(np.deg2rad(min_angle))
+    point = ephemeris.unit_vector(az, alt)
+
+    safe = np.empty(len(t), dtype=bool)
+    for i0 in range(0, len(t), SUN_CHUNK):
+        i1 = min(i0 + SUN_CHUNK, len(t))
+        # (3, samples, window) view of the Sun over each sample's window
+        window = sliding_window_view(sun[:, i0:i1 + width - 1], width, axis=1)
+        dot = np.einsum('ij,ijk->jk', point[:, i0:i1], window)
+        safe[i0:i1] = dot.max(axis=1) < cos_min
+    return safe
@@ -0,0 +1,53 @@
+"""Time axes as numpy arrays.
+
+Pages build their time grids here as float ctime arrays (for ephemeris
+and interval arithmetic) and hand ``numpy.datetime64`` views of them to
+matplotlib and plotly, which both accept datetime64 directly. This
+avoids creating a Python ``datetime`` object per sample on multi-day
+windows.
+"""
+import datetime as dt
+
+import numpy as np
+import pandas as pd
+
+
+def ctime(t):
+    """ctime (float seconds) of a datetime; naive datetimes are taken as UTC."""
+    if t.tzinfo is None:
+        t = t.replace(tzinfo=dt.timezone.utc)
+    return t.timestamp()
+
+
+def ctime_grid(t0, t1, step, endpoint=False):
+    """Evenly spaced ctimes from t0 to t1 (datetimes) every step seconds."""
+    c0 = ctime(t0)
+    c1 = ctime(t1)
+    n = int(np.floor((c1 - c0) / step))
+    if endpoint:
+        n += 1
+    return c0 + step * np.arange(n)
+
+
+def to_datetime64(ctimes, tz=None, unit='us'):
+    """datetime64 array for ctimes.
+
+    The result is UTC unless tz is given, in which case the wall-clock
+    time in tz is returned (datetime64 has no time zone), which is what
+    matplotlib should display for a local time axis.
+    """
+    ctimes = np.asarray(ctimes, dtype=float)
+    scale = np.timedelta64(1, 's') / np.timedelta64(1, unit)
+    t = np.round(ctimes * scale).astype(np.int64).view(f'datetime64[{unit}]')
+    if tz is None or tz == dt.timezone.utc:
+        return t
+    return (
+        pd.DatetimeIndex(t.ravel()).tz_localize('UTC').tz_convert(tz)
+        .tz_localize(None).to_numpy().reshape(t.shape)
+    )
+
+
+def to_ctime(times):
+    """ctimes for a datetime64 array (UTC), the inverse of to_datetime64."""
+    times = np.asarray(times).astype('datetime64[us]')
+    return times.view(np.int64) / 1e6
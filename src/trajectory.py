@@ -0,0 +1,135 @@
+"""Boresight trajectories of scan blocks for the planner plots.
+
+The planners only need timestamps and the boresight az/el/roll of a scan
+block to compute its sightline, so this keeps them as plain arrays
+rather than building a detector AxisManager per block. Long drift scans
+can be decimated to a plotting-appropriate number of samples before the
+quaternion work, and many blocks can share one sightline computation
+(see source_xieta).
+"""
+import numpy as np
+from so3g.proj import quat, CelestialSightLine
+from sotodlib import coords
+
+DEG = np.pi / 180
+
+
+class Trajectory:
+    """Timestamps (ctime) and boresight az, el, roll (radians)."""
+
+    def __init__(self, timestamps, az, el, roll):
+        self.timestamps = np.asarray(timestamps, dtype=float)
+        n = len(self.timestamps)
+        # constant el or roll may be given as scalars
+        self.az = np.zeros(n) + az
+        self.el = np.zeros(n) + el
+        self.roll = np.zeros(n) + roll
+
+    @classmethod
+    def from_block(cls, block, max_samples=None):
+        """Trajectory of a schedlib scan block.
+
+        Args:
+          block: block with ``get_az_alt`` (degrees) and
+            ``boresight_angle`` (degrees).
+          max_samples (int): decimate to at most this many samples.
+        """
+        t, az, alt = block.get_az_alt()
+        traj = cls(
+            t,
+            np.mod(az, 360) * DEG,
+            np.asarray(alt) * DEG,
+            block.boresight_angle * DEG,
+        )
+        if max_samples is not None:
+            traj = traj.decimate(max_samples)
+        return traj
+
+    def __len__(self):
+        return len(self.timestamps)
+
+    def decimate(self, max_samples):
+        """Every k-th sample, plus the last, for at most max_samples samples."""
+        n = len(self)
+        if n <= max_samples:
+            return self
+        step = int(np.ceil((n - 1) / max(max_samples - 1, 1)))
+        idx = np.r_[np.arange(0, n - 1, step), n - 1]
+        return Trajectory(
+            self.timestamps[idx], self.az[idx], self.el[idx], self.roll[idx]
+        )
+
+    def sightline(self, weather='vacuum'):
+        """CelestialSightLine of the boresight."""
+        return CelestialSightLine.az_el(
+            self.timestamps, self.az, self.el, weather=weather
+        )
+
+
+def concatenate(trajs):
+    """One Trajectory holding all of trajs, and the offsets to split it.
+
+    Trajectory i is samples offsets[i]:offsets[i+1] of the result.
+    """
+    offsets = np.cumsum([0] + [len(t) for t in trajs])
+    traj = Trajectory(
+        np.concatenate([t.timestamps for t in trajs]),
+        np.concatenate([t.az for t in trajs]),
+        np.concatenate([t.el for t in trajs]),
+        np.concatenate([t.roll for t in trajs]),
+    )
+    return traj, offsets
+
+
+def xieta_source_name(source):
+    """Name of a planner source as understood by source_xieta.
+
+    ``SlowSource.for_named_source`` does not resolve TauA by name, so it
+    is given by its position from sotodlib's source list instead.
+    """
+    if source.lower() == 'taua':
+        x = [
+            x for x in coords.planets.SOURCE_LIST
+            if isinstance(x, tuple) and x[0] == 'tauA'
+        ][0]
+        return f"J{x[1]}+{x[2]}"
+    return source
+
+
+def source_xieta(trajs, source, weather='vacuum'):
+    """Track of a named source in boresight (xi, eta), per trajectory.
+
+    All trajectories go through a single sightline and quaternion pass
+    on their concatenation. The source position is evaluated once per
+    trajectory, at its mean time, as it moves slowly.
+
+    Args:
+      trajs (list of Trajectory): e.g. one per scan block.
+      source (str): name known to ``SlowSource.for_named_source``
+        (see xieta_source_name).
+
+    Returns:
+      list of (xi, eta) arrays in radians, one per trajectory.
+    """
+    if len(trajs) == 0:
+        return []
+    traj, offsets = concatenate(trajs)
+    csl = traj.sightline(weather=weather)
+    ra, dec, _ = quat.decompose_lonlat(csl.Q)
+
+    ra0 = np.zeros(len(traj))
+    dec0 = np.zeros(len(traj))
+    for a, b in zip(offsets[:-1], offsets[1:]):
+        if b == a:
+            continue
+        src_path = coords.planets.SlowSource.for_named_source(
+            source, traj.timestamps[a:b].mean()
+        )
+        ra0[a:b] = (src_path.ra - ra[a]) % (2 * np.pi) + ra[a]
+        dec0[a:b] = src_path.dec
+
+    # Un-rotate the source into boresight coords.
+    xip, etap, _ = quat.decompose_xieta(~csl.Q * quat.rotation_lonlat(ra0, dec0))
+    return [
+        (xip[a:b], etap[a:b]) for a, b in zip(offsets[:-1], offsets[1:])
+    ]